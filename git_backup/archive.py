@@ -0,0 +1,230 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import gzip
+import hashlib
+import io
+import os
+import stat
+import struct
+import tarfile
+import zipfile
+import zlib
+from typing import BinaryIO, Deque, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError: # optional, only needed for `zstdtar`
+    zstandard = None
+
+from git_backup.logger import get_logger
+from git_backup.types import CompressType
+
+log = get_logger('archive')
+
+# 1980-01-01 00:00:00 UTC, the earliest timestamp zip can represent
+FIXED_MTIME = 315532800
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+TAR_MODES = {
+    "tar": 'w',
+    "bztar": 'w:bz2',
+    "xztar": 'w:xz'
+}
+
+# archive types written by this module rather than `shutil.make_archive`
+PARALLEL_TYPES = ('pgztar', 'zstdtar')
+
+# uncompressed bytes per `pgztar` block, each compressed independently
+PGZ_BLOCK_SIZE = 1024 * 1024
+# window carried between `pgztar` blocks as a preset dictionary
+PGZ_DICT_SIZE = 32 * 1024
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Write-only file producing a single gzip member, compressing blocks on a thread pool
+
+    Like pigz, each block is raw deflated with the tail of the previous block as
+    its dictionary and ends on a sync flush, so the compressed blocks can simply
+    be concatenated. zlib releases the GIL while compressing, so blocks compress
+    on as many cores as `threads`. Output is identical for any thread count.
+    """
+    def __init__(self, fileobj: BinaryIO, level: int = 6, threads: int = 0, block_size: int = PGZ_BLOCK_SIZE) -> None:
+        super().__init__()
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='pgz')
+        self.pending: Deque[Future] = deque()
+        self.buf = bytearray()
+        self.prev_tail = b''
+        self.crc = 0
+        self.size = 0
+        # magic, deflate, no flags, mtime 0, no extra flags, unknown OS
+        self.fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', 0) + b'\x00\xff')
+
+    def writable(self) -> bool:
+        return True
+
+    def _compress(self, block: bytes, zdict: bytes) -> bytes:
+        if zdict:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=zdict)
+        else:
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def _submit(self, block: bytes):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.pool.submit(self._compress, block, self.prev_tail))
+        self.prev_tail = block[-PGZ_DICT_SIZE:]
+        # bound memory to a couple of blocks per thread
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data) -> int:
+        self.buf += data
+        while len(self.buf) >= self.block_size:
+            self._submit(bytes(self.buf[:self.block_size]))
+            del self.buf[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.buf:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        # empty final block, then crc32 and size of the uncompressed data
+        self.fileobj.write(zlib.compressobj(self.level, zlib.DEFLATED, -15).flush(zlib.Z_FINISH))
+        self.fileobj.write(struct.pack('<II', self.crc, self.size & 0xFFFFFFFF))
+        super().close()
+
+def _walk_sorted(root_dir: str, base_dir: str) -> Iterator[Tuple[str, str, os.stat_result]]:
+    """
+    Yield (arcname, path, lstat) for `base_dir` and everything below it, in sorted order
+    """
+    base_path = os.path.join(root_dir, base_dir)
+    yield base_dir, base_path, os.lstat(base_path)
+
+    stack = [base_dir]
+    while stack:
+        arc_dir = stack.pop()
+        with os.scandir(os.path.join(root_dir, arc_dir)) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        subdirs = []
+        for entry in entries:
+            arcname = f'{arc_dir}/{entry.name}'
+            yield arcname, entry.path, entry.stat(follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(arcname)
+        # reversed so the stack pops them in sorted order
+        stack.extend(reversed(subdirs))
+
+def list_entries(root_dir: str, base_dir: str) -> List[Tuple[str, str, os.stat_result]]:
+    base_path = os.path.join(root_dir, base_dir)
+    if not os.path.isdir(base_path) or os.path.islink(base_path):
+        return [(base_dir, base_path, os.lstat(base_path))]
+    return list(_walk_sorted(root_dir, base_dir))
+
+def fingerprint(entries: List[Tuple[str, str, os.stat_result]]) -> str:
+    """
+    Cheap fingerprint of archive inputs from names, types, sizes, modes and mtimes
+    """
+    hash = hashlib.sha256()
+    for arcname, _, st in entries:
+        hash.update(f'{arcname}\0{stat.S_IFMT(st.st_mode)}\0{st.st_mode & 0o111 != 0}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode('utf8', 'surrogateescape'))
+    return f'sha256:{hash.hexdigest()}'
+
+def _normal_mode(st: os.stat_result) -> int:
+    if stat.S_ISDIR(st.st_mode) or st.st_mode & 0o111:
+        return 0o755
+    return 0o644
+
+def write_zip(fileobj: BinaryIO, entries: List[Tuple[str, str, os.stat_result]], level: Optional[int] = None):
+    with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=level) as zf:
+        for arcname, path, st in entries:
+            if stat.S_ISDIR(st.st_mode):
+                info = zipfile.ZipInfo(f'{arcname}/', FIXED_DATE_TIME)
+                info.external_attr = (stat.S_IFDIR | 0o755) << 16 | 0x10
+                zf.writestr(info, b'')
+                continue
+            # like shutil.make_archive, zip stores the content symlinks point to
+            if not os.path.isfile(path):
+                continue
+            info = zipfile.ZipInfo(arcname, FIXED_DATE_TIME)
+            info.external_attr = (stat.S_IFREG | _normal_mode(os.stat(path))) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+                while True:
+                    buf = src.read(1024 * 1024)
+                    if not buf:
+                        break
+                    dst.write(buf)
+
+def write_tar(tf: tarfile.TarFile, entries: List[Tuple[str, str, os.stat_result]]):
+    for arcname, path, st in entries:
+        info = tf.gettarinfo(path, arcname)
+        info.mtime = FIXED_MTIME
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        info.mode = _normal_mode(st)
+        if info.isreg():
+            with open(path, 'rb') as src:
+                tf.addfile(info, src)
+        else:
+            tf.addfile(info)
+
+def _tar_kwargs(archive_type: CompressType, level: Optional[int]) -> dict:
+    if level is None or archive_type == 'tar':
+        return {}
+    if archive_type == 'xztar':
+        return {"preset": level}
+    return {"compresslevel": level}
+
+def write_archive(raw: BinaryIO, archive_type: CompressType, entries: List[Tuple[str, str, os.stat_result]], level: Optional[int] = None, threads: int = 0):
+    """
+    Write a reproducible archive of `entries` to the open file `raw`, which only
+    needs to support `write()` and `tell()`
+    """
+    if archive_type == 'zip':
+        write_zip(raw, entries, level)
+    elif archive_type == 'gztar':
+        # gzip header carries a filename and mtime unless told otherwise
+        with gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=0, compresslevel=9 if level is None else level) as gz:
+            with tarfile.open(fileobj=gz, mode='w', format=tarfile.PAX_FORMAT) as tf:
+                write_tar(tf, entries)
+    elif archive_type == 'pgztar':
+        with ParallelGzipWriter(raw, 6 if level is None else level, threads) as gz:
+            with tarfile.open(fileobj=gz, mode='w|', format=tarfile.PAX_FORMAT) as tf:
+                write_tar(tf, entries)
+    elif archive_type == 'zstdtar':
+        if zstandard is None:
+            log.error('ERROR: make_archive() archive type zstdtar requires the `zstandard` package')
+            raise RuntimeError('Archive type zstdtar requires the `zstandard` package')
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level, threads=threads or -1)
+        with compressor.stream_writer(raw, closefd=False) as zst:
+            with tarfile.open(fileobj=zst, mode='w|', format=tarfile.PAX_FORMAT) as tf:
+                write_tar(tf, entries)
+    elif archive_type in TAR_MODES:
+        with tarfile.open(fileobj=raw, mode=TAR_MODES[archive_type], format=tarfile.PAX_FORMAT, **_tar_kwargs(archive_type, level)) as tf:
+            write_tar(tf, entries)
+    else:
+        raise ValueError(f'Unknown archive type: {archive_type}')
+
+def make_archive(dest: str, archive_type: CompressType, entries: List[Tuple[str, str, os.stat_result]], level: Optional[int] = None, threads: int = 0) -> str:
+    """
+    Write a reproducible archive of `entries` to `dest`
+
+    Entries are sorted, timestamps fixed, owners dropped and permissions normalized
+    so identical inputs always produce identical bytes. `pgztar` and `zstdtar`
+    compress on `threads` cores (0 for all of them).
+    """
+    tmp_path = f'{dest}.tmp'
+    with open(tmp_path, 'wb') as raw:
+        write_archive(raw, archive_type, entries, level, threads)
+    os.replace(tmp_path, dest)
+    return dest
@@ -0,0 +1,627 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import hashlib
+import io
+import os
+from typing import BinaryIO, Iterator, List, Optional, Set, Tuple
+
+from git_backup.logger import get_logger
+from git_backup.types import ChunkEntry, ChunkingConfig, Manifest
+
+log = get_logger('chunking')
+
+# content addressed chunks shared by every chunked file in the repo, relative to repo root
+CHUNK_STORE_DIR = '.chunks'
+
+# chunks being written to the store, renamed into place once complete
+CHUNK_TMP_PATTERN = f'{CHUNK_STORE_DIR}/*/*.tmp'
+
+MANIFEST_NAME = 'manifest'
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024 # 1MB
+
+# 32 bit gear table for the rolling hash, derived rather than random so boundaries are stable across versions
+GEAR = [int.from_bytes(hashlib.sha256(b'git-backup-gear' + bytes([i])).digest()[:4], 'big') for i in range(256)]
+
+def parse_manifest(text: str) -> Manifest:
+    """
+    Parse the contents of a chunk manifest, raises ValueError if malformed
+    """
+    manifest: Manifest = {
+        "version": 0,
+        "name": '',
+        "oid": '',
+        "size": 0,
+        "chunks": 0,
+        "chunker": 'fixed',
+        "store": None,
+        "chunk_list": []
+    }
+    for line in text.split('\n'):
+        key, _, value = line.partition(' ')
+        if key in ('version', 'size', 'chunks'):
+            manifest[key] = int(value)
+        elif key in ('name', 'oid', 'chunker', 'store'):
+            manifest[key] = value
+        elif key == 'chunk':
+            oid, size = value.split(' ')
+            manifest['chunk_list'].append((oid, int(size)))
+    return manifest
+
+def read_manifest(manifest_path: str) -> Optional[Manifest]:
+    """
+    Parse a chunk manifest, returns None if it doesn't exist or can't be read
+    """
+    try:
+        with open(manifest_path, 'r', encoding='utf8') as stream:
+            return parse_manifest(stream.read())
+    except Exception as e:
+        if not isinstance(e, IOError) or e.errno != 2:
+            log.warning(f'read_manifest() could not read manifest {manifest_path}: {e}')
+        return None
+
+def write_manifest(manifest_path: str, manifest: Manifest):
+    lines = [
+        f'version {manifest["version"]}',
+        f'name {manifest["name"]}',
+        f'oid {manifest["oid"]}',
+        f'size {manifest["size"]}',
+        f'chunks {manifest["chunks"]}'
+    ]
+    if manifest['chunker'] != 'fixed':
+        lines.append(f'chunker {manifest["chunker"]}')
+    if manifest['store'] is not None:
+        lines.append(f'store {manifest["store"]}')
+    for oid, size in manifest['chunk_list']:
+        lines.append(f'chunk {oid} {size}')
+
+    with open(manifest_path, 'w', encoding='utf8') as stream:
+        stream.write('\n'.join(lines) + '\n')
+
+def _next_version(manifest_path: str) -> int:
+    prev = read_manifest(manifest_path)
+    return prev['version'] + 1 if prev else 1
+
+def _stream(fd: int, offset: int, size: int, view: memoryview, hashes: tuple, out: Optional[BinaryIO] = None) -> int:
+    """
+    Copy up to `size` bytes at `offset` of `fd` through the reused buffer `view`, updating
+    `hashes` and writing to `out` if given, returns the number of bytes read
+
+    Positional reads don't share a file offset, so threads can stream ranges of the same `fd`.
+    """
+    done = 0
+    while done < size:
+        n = os.preadv(fd, [view[:min(len(view), size - done)]], offset + done)
+        if not n:
+            break
+        piece = view[:n]
+        for hash in hashes:
+            hash.update(piece)
+        if out is not None:
+            out.write(piece)
+        done += n
+    return done
+
+def _file_size(path: str) -> int:
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return -1
+
+def _chunk_range(fd: int, chunk_path: str, offset: int, size: int, view: memoryview, prev_chunk: Optional[ChunkEntry], hashes: tuple) -> tuple:
+    """
+    Hash and write a single fixed size chunk, returns (oid, bytes_read, bytes_written)
+    """
+    chunk_hash = hashlib.sha256()
+
+    if prev_chunk is not None and prev_chunk[1] == size and _file_size(chunk_path) == size:
+        # likely unchanged, hash first and only rewrite on mismatch
+        n = _stream(fd, offset, size, view, hashes + (chunk_hash,))
+        oid = f'sha256:{chunk_hash.hexdigest()}'
+        if oid == prev_chunk[0] and n == size:
+            return oid, n, 0
+        with open(chunk_path, 'wb') as chunk_file:
+            n = _stream(fd, offset, n, view, (), chunk_file)
+        return oid, n, n
+
+    with open(chunk_path, 'wb') as chunk_file:
+        n = _stream(fd, offset, size, view, hashes + (chunk_hash,), chunk_file)
+    return f'sha256:{chunk_hash.hexdigest()}', n, n
+
+def chunk_fixed(path: str, chunk_size: int, buffer_size: int = DEFAULT_BUFFER_SIZE, workers: int = 1) -> Manifest:
+    """
+    Split `path` into `<path>.d/0..N` of `chunk_size` bytes each
+
+    Reads through `buffer_size` buffers, hashing as it goes. Chunks whose hash matches
+    the previous manifest are left untouched on disk. With `workers` > 1 chunks are
+    processed in a thread pool while another thread hashes the whole file, the
+    resulting manifest is identical to the serial one.
+    """
+    full_size = os.stat(path).st_size
+    chunk_dir = f'{path}.d'
+    manifest_path = os.path.join(chunk_dir, MANIFEST_NAME)
+
+    # make directory to hold chunks
+    os.makedirs(chunk_dir, exist_ok=True)
+
+    prev = read_manifest(manifest_path)
+    prev_chunks = prev['chunk_list'] if prev and prev['chunker'] == 'fixed' else []
+    buffer_size = min(buffer_size, chunk_size)
+    offsets = range(0, full_size, chunk_size)
+
+    def _prev(i: int) -> Optional[ChunkEntry]:
+        return prev_chunks[i] if i < len(prev_chunks) else None
+
+    # hash of original file
+    hash = hashlib.sha256()
+    results = []
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if workers > 1 and len(offsets) > 1:
+            def _chunk(i: int) -> tuple:
+                view = memoryview(bytearray(buffer_size))
+                size = min(chunk_size, full_size - offsets[i])
+                return _chunk_range(fd, os.path.join(chunk_dir, str(i)), offsets[i], size, view, _prev(i), ())
+
+            with ThreadPoolExecutor(max_workers=workers + 1, thread_name_prefix='chunk') as pool:
+                hashed = pool.submit(_stream, fd, 0, full_size, memoryview(bytearray(buffer_size)), (hash,))
+                results = list(pool.map(_chunk, range(len(offsets))))
+                hashed.result()
+        else:
+            view = memoryview(bytearray(buffer_size))
+            for i, offset in enumerate(offsets):
+                size = min(chunk_size, full_size - offset)
+                results.append(_chunk_range(fd, os.path.join(chunk_dir, str(i)), offset, size, view, _prev(i), (hash,)))
+                if results[-1][1] < size:
+                    break
+    finally:
+        os.close(fd)
+
+    # stop at the first short read in case the file shrank while chunking
+    chunk_list = []
+    written = 0
+    for i, (oid, n, chunk_written) in enumerate(results):
+        if n:
+            chunk_list.append((oid, n))
+            written += chunk_written
+        if n < min(chunk_size, full_size - offsets[i]):
+            break
+
+    # drop chunks past the end of the file, or left over from a previous chunking mode
+    for entry in os.scandir(chunk_dir):
+        if entry.name.isdigit() and int(entry.name) >= len(chunk_list):
+            os.remove(entry.path)
+
+    manifest: Manifest = {
+        "version": prev['version'] + 1 if prev else 1,
+        "name": os.path.basename(path),
+        "oid": f'sha256:{hash.hexdigest()}',
+        "size": sum(n for _, n in chunk_list),
+        "chunks": len(chunk_list),
+        "chunker": 'fixed',
+        "store": None,
+        "chunk_list": chunk_list
+    }
+    write_manifest(manifest_path, manifest)
+
+    log.info(f'chunk_fixed() path={path} chunks={len(chunk_list)} new_bytes={written} workers={workers}')
+    return manifest
+
+def cdc_sizes(avg_size: int, max_file_size: int) -> tuple:
+    """
+    (min, avg, max) chunk sizes for content defined chunking, max never exceeds `max_file_size`
+    """
+    max_size = min(avg_size * 4, max_file_size)
+    avg_size = min(avg_size, max_size)
+    return max(avg_size // 4, 1), avg_size, max_size
+
+# low bits of the gear hash `_candidates()` computes for a whole block at once, in 16 bit
+# lanes with room for the carries of its doubling steps
+FILTER_BITS = 13
+
+# bytes `_cut()` scans per `_candidates()` call, small so a cut isn't overshot by much
+CUT_BLOCK = 16 * 1024
+
+@lru_cache(maxsize=64)
+def _lanes(count: int, value: int) -> int:
+    """
+    `count` 16 bit lanes each holding `value`, as a single int
+    """
+    return int.from_bytes(value.to_bytes(2, 'little') * count, 'little')
+
+@lru_cache(maxsize=8)
+def _gear_tables(bits: int) -> Tuple[bytes, bytes]:
+    """
+    Translation tables to the low and high byte of the gear values' low `bits`
+    """
+    mask = (1 << bits) - 1
+    return bytes(g & mask & 0xFF for g in GEAR), bytes((g & mask) >> 8 for g in GEAR)
+
+def _candidates(seg: bytearray, bits: int) -> Iterator[int]:
+    """
+    Offsets in `seg` where the low `bits` (at most `FILTER_BITS`) of the gear hash of
+    `seg` up to there are zero
+
+    The low `bits` of the hash only depend on the last `bits` bytes, the sum of their
+    gear values shifted by their distance. That sum is worked out for every byte at once
+    with a lane per byte in one big int: each of the doubling steps adds lane i - m
+    shifted by m to lane i, for m = 1, 2, 4, 8. Carries stay within a lane, past `bits`.
+    """
+    n = len(seg)
+    low, high = _gear_tables(bits)
+    lanes = bytearray(2 * n)
+    lanes[0::2] = seg.translate(low)
+    if bits > 8:
+        lanes[1::2] = seg.translate(high)
+    h = int.from_bytes(lanes, 'little')
+    m = 1
+    while m < bits:
+        h += (h & _lanes(n, (1 << (bits - m)) - 1)) << (17 * m)
+        m *= 2
+    # 1 in the lowest bit of every lane whose low `bits` are all zero
+    zero = ((_lanes(n, 1 << bits) - (h & _lanes(n, (1 << bits) - 1))) >> bits) & _lanes(n, 1)
+    if not zero:
+        return
+    zero_bytes = zero.to_bytes(2 * n, 'little')
+    i = zero_bytes.find(1)
+    while i != -1:
+        yield i // 2
+        i = zero_bytes.find(1, i + 2)
+
+def _gear_at(data: bytearray, i: int, begin: int, bits: int) -> int:
+    """
+    Low `bits` of the gear hash from `begin` up to and including `data[i]`
+    """
+    h = 0
+    gear = GEAR
+    for b in data[max(begin, i - bits + 1):i + 1]:
+        h = (h << 1) + gear[b]
+    return h & ((1 << bits) - 1)
+
+def _cut(data: bytearray, start: int, end: int, min_size: int, avg_size: int, max_size: int) -> int:
+    """
+    Length of the next chunk in `data[start:end]`, using a gear rolling hash with
+    normalized chunking (harder to cut before `avg_size`, easier after)
+
+    Positions whose low `FILTER_BITS` of the hash aren't zero are ruled out a block at a
+    time, only the few left are checked byte by byte. The cuts are those of hashing
+    every byte in turn.
+    """
+    n = end - start
+    if n <= min_size:
+        return n
+    if n > max_size:
+        n = max_size
+
+    bits = avg_size.bit_length() - 1
+    bits_s = bits + 2
+    bits_l = max(bits - 2, 1)
+    filter_bits = min(FILTER_BITS, bits_l)
+
+    # the hash starts over at `begin`
+    begin = start + min_size
+    normal = start + min(avg_size, n)
+    stop = start + n
+    pos = begin
+    while pos < stop:
+        block_end = min(pos + CUT_BLOCK, stop)
+        # enough of the previous block for the filtered bits of the hash at `pos`
+        context = max(begin, pos - filter_bits)
+        for offset in _candidates(data[context:block_end], filter_bits):
+            i = context + offset
+            if i >= pos and not _gear_at(data, i, begin, bits_s if i < normal else bits_l):
+                return i + 1 - start
+        pos = block_end
+    return n
+
+def iter_cdc(f: BinaryIO, min_size: int, avg_size: int, max_size: int) -> Iterator[bytes]:
+    """
+    Yield content defined chunks of `f`, holding at most ~2x `max_size` in memory
+    """
+    buf = bytearray()
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - start < max_size:
+            del buf[:start]
+            start = 0
+            data = f.read(max_size)
+            if data:
+                buf += data
+            else:
+                eof = True
+            continue
+        if start >= len(buf):
+            return
+        n = _cut(buf, start, len(buf), min_size, avg_size, max_size)
+        yield bytes(buf[start:start + n])
+        start += n
+
+def store_chunk(store_path: str, oid: str, data: bytes) -> bool:
+    """
+    Write chunk into the store unless it's already there, returns whether it was written
+    """
+    digest = oid.split(':', 1)[1]
+    chunk_path = os.path.join(store_path, digest[:2], digest)
+    if os.path.exists(chunk_path):
+        return False
+
+    os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+    tmp_path = f'{chunk_path}.tmp'
+    with open(tmp_path, 'wb') as chunk_file:
+        chunk_file.write(data)
+    os.replace(tmp_path, chunk_path)
+    return True
+
+def prune_store(store_path: str, referenced: Set[str]) -> List[str]:
+    """
+    Delete chunks of the store no oid in `referenced` points at, returns their paths
+    """
+    removed = []
+    for sub in os.scandir(store_path):
+        if not sub.is_dir():
+            continue
+        for entry in os.scandir(sub.path):
+            if f'sha256:{entry.name}' not in referenced:
+                os.remove(entry.path)
+                removed.append(entry.path)
+        if not os.listdir(sub.path):
+            os.rmdir(sub.path)
+    return removed
+
+def chunk_cdc(path: str, repo_path: str, config: ChunkingConfig, max_file_size: int) -> Manifest:
+    """
+    Split `path` at content defined boundaries into the repo's shared chunk store,
+    `<path>.d/manifest` lists the chunks in order
+    """
+    chunk_dir = f'{path}.d'
+    manifest_path = os.path.join(chunk_dir, MANIFEST_NAME)
+    store_path = os.path.join(repo_path, CHUNK_STORE_DIR)
+    min_size, avg_size, max_size = cdc_sizes(config['avg_size'], max_file_size)
+
+    os.makedirs(chunk_dir, exist_ok=True)
+
+    hash = hashlib.sha256()
+    chunk_list = []
+    written = 0
+    with open(path, 'rb') as f:
+        for chunk in iter_cdc(f, min_size, avg_size, max_size):
+            hash.update(chunk)
+            oid = f'sha256:{hashlib.sha256(chunk).hexdigest()}'
+            if store_chunk(store_path, oid, chunk):
+                written += len(chunk)
+            chunk_list.append((oid, len(chunk)))
+
+    # drop fixed size chunks left over from a previous chunking mode
+    for entry in os.scandir(chunk_dir):
+        if entry.name.isdigit():
+            os.remove(entry.path)
+
+    manifest: Manifest = {
+        "version": _next_version(manifest_path),
+        "name": os.path.basename(path),
+        "oid": f'sha256:{hash.hexdigest()}',
+        "size": sum(size for _, size in chunk_list),
+        "chunks": len(chunk_list),
+        "chunker": 'cdc',
+        "store": os.path.relpath(store_path, chunk_dir),
+        "chunk_list": chunk_list
+    }
+    write_manifest(manifest_path, manifest)
+
+    log.info(f'chunk_cdc() path={path} chunks={len(chunk_list)} new_bytes={written}')
+    return manifest
+
+
+class ChunkWriter(io.RawIOBase):
+    """
+    Write-only file for output of unknown size, eg. an archive being compressed, that
+    lands at `path` while it's at most `max_size` bytes and is chunked on the fly past that
+
+    Once the output outgrows `max_size`, what was written so far becomes the first
+    chunk (`fixed`) or is cut from one read back of it (`cdc`), and the rest streams
+    straight into chunks, hashed as it's written. `<path>.d/` ends up as `chunk_fixed()`
+    or `chunk_cdc()` would leave it for the whole output, without the whole output ever
+    being on disk at `path`. Memory use stays within a chunk, and only for `cdc`.
+    """
+    def __init__(self, path: str, max_size: int, config: ChunkingConfig, repo_path: str) -> None:
+        super().__init__()
+        self.path = path
+        self.max_size = max_size
+        self.config = config
+        self.repo_path = repo_path
+        self.chunk_dir = f'{path}.d'
+        self.manifest_path = os.path.join(self.chunk_dir, MANIFEST_NAME)
+
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.spilled = False
+        self.written = 0 # bytes of chunks actually (re)written
+        self.chunk_list: List[ChunkEntry] = []
+        # finished `fixed` chunks still under their temporary name -> where they go
+        self.pending: List[Tuple[str, str]] = []
+
+        # the file currently written to and the hash of what's in it
+        self.out_path = f'{path}.tmp'
+        self.out = open(self.out_path, 'wb')
+        self.out_hash = hashlib.sha256()
+        self.out_size = 0
+
+        self.prev_chunks: List[ChunkEntry] = []
+        # pending `cdc` bytes not cut into chunks yet
+        self.buf = bytearray()
+        self.store_path = os.path.join(repo_path, CHUNK_STORE_DIR)
+        self.cdc = cdc_sizes(config['avg_size'], max_size) if config['mode'] == 'cdc' else None
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.size
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast('B')
+        n = len(view)
+        self.hash.update(view)
+        self.size += n
+
+        while len(view):
+            if not self.spilled:
+                room = self.max_size - self.out_size
+                if room > 0:
+                    self._write_out(view[:room])
+                    view = view[room:]
+                    continue
+                self._spill()
+            if self.cdc is not None:
+                self._cut_chunks(view)
+                break
+            room = self.max_size - self.out_size
+            if room == 0:
+                self._roll()
+                continue
+            self._write_out(view[:room])
+            view = view[room:]
+        return n
+
+    def _write_out(self, view: memoryview):
+        self.out.write(view)
+        self.out_hash.update(view)
+        self.out_size += len(view)
+
+    def _spill(self):
+        """
+        Switch from writing `path` to writing chunks
+        """
+        self.spilled = True
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        prev = read_manifest(self.manifest_path)
+        if prev and prev['chunker'] == ('cdc' if self.cdc else 'fixed'):
+            self.prev_chunks = prev['chunk_list']
+        self.version = prev['version'] + 1 if prev else 1
+
+        if self.cdc is None:
+            # exactly one chunk's worth, it already is the first chunk
+            self._roll()
+            return
+
+        self.out.close()
+        with open(self.out_path, 'rb') as f:
+            while True:
+                data = f.read(self.cdc[2])
+                if not data:
+                    break
+                self._cut_chunks(memoryview(data))
+        os.remove(self.out_path)
+        self.out = None
+
+    def _finish_chunk(self):
+        """
+        Close the current `fixed` chunk, keeping the previous file if it's unchanged
+
+        A changed chunk stays under its temporary name until `close()`, the previous
+        manifest still describes `<path>.d/` should the output be aborted.
+        """
+        self.out.close()
+        i = len(self.chunk_list)
+        oid = f'sha256:{self.out_hash.hexdigest()}'
+        chunk_path = os.path.join(self.chunk_dir, str(i))
+        prev = self.prev_chunks[i] if i < len(self.prev_chunks) else None
+        if prev == (oid, self.out_size) and _file_size(chunk_path) == self.out_size:
+            os.remove(self.out_path)
+        else:
+            self.pending.append((self.out_path, chunk_path))
+            self.written += self.out_size
+        self.chunk_list.append((oid, self.out_size))
+
+    def _roll(self):
+        self._finish_chunk()
+        self.out_path = os.path.join(self.chunk_dir, f'{len(self.chunk_list)}.tmp')
+        self.out = open(self.out_path, 'wb')
+        self.out_hash = hashlib.sha256()
+        self.out_size = 0
+
+    def _cut_chunks(self, view: memoryview, final: bool = False):
+        """
+        Cut every `cdc` chunk that is certain, all that's left if `final`
+        """
+        min_size, avg_size, max_size = self.cdc
+        self.buf += view
+        start = 0
+        # like `iter_cdc()`, a cut only depends on the next `max_size` bytes
+        while len(self.buf) - start >= max_size or (final and start < len(self.buf)):
+            n = _cut(self.buf, start, len(self.buf), min_size, avg_size, max_size)
+            chunk = bytes(self.buf[start:start + n])
+            oid = f'sha256:{hashlib.sha256(chunk).hexdigest()}'
+            if store_chunk(self.store_path, oid, chunk):
+                self.written += n
+            self.chunk_list.append((oid, n))
+            start += n
+        del self.buf[:start]
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self.spilled:
+                self.out.close()
+                os.replace(self.out_path, self.path)
+            else:
+                if self.cdc is None:
+                    if self.out_size or not self.chunk_list:
+                        self._finish_chunk()
+                    else:
+                        # ended right at a chunk boundary
+                        self.out.close()
+                        os.remove(self.out_path)
+                    for tmp_path, chunk_path in self.pending:
+                        os.replace(tmp_path, chunk_path)
+                    self.pending = []
+                else:
+                    self._cut_chunks(memoryview(b''), final=True)
+                self._write_manifest()
+        finally:
+            super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        # a failed write must not be mistaken for the complete output
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def abort(self):
+        """
+        Drop whatever was written, leaving `path` and its chunks as they were
+        """
+        if self.out is not None and not self.out.closed:
+            self.out.close()
+        for tmp_path in [self.out_path] + [tmp_path for tmp_path, _ in self.pending]:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.pending = []
+        super().close()
+
+    def _write_manifest(self):
+        # drop chunks past the end, or left over from a previous chunking mode
+        for entry in os.scandir(self.chunk_dir):
+            if entry.name.isdigit() and (self.cdc is not None or int(entry.name) >= len(self.chunk_list)):
+                os.remove(entry.path)
+
+        manifest: Manifest = {
+            "version": self.version,
+            "name": os.path.basename(self.path),
+            "oid": f'sha256:{self.hash.hexdigest()}',
+            "size": self.size,
+            "chunks": len(self.chunk_list),
+            "chunker": 'cdc' if self.cdc else 'fixed',
+            "store": os.path.relpath(self.store_path, self.chunk_dir) if self.cdc else None,
+            "chunk_list": self.chunk_list
+        }
+        write_manifest(self.manifest_path, manifest)
+
+        # the whole file from a previous, unstreamed, sync would be stale now
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        log.info(f'ChunkWriter() path={self.path} chunks={len(self.chunk_list)} new_bytes={self.written}')
@@ -1,15 +1,15 @@
 from logging import StreamHandler, Formatter
 import os
-from typing import Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple, get_args
 import sys
 
 import yaml
 
 from git_backup.cron import Cron
 from git_backup.env import get_env
-from git_backup.logger import get_logger, get_root_logger
+from git_backup.logger import ContextFilter, RedactFilter, get_logger, get_root_logger
 from git_backup.secrets import Secrets
-from git_backup.types import CompressType, GitConfig, LoopConfig, PathConfig, RSyncConfig, RepoConfig, Config, SecretsConfig, StorageConfig
+from git_backup.types import ArchiveConfig, ChunkerType, ChunkingConfig, CompressType, GitConfig, LoopConfig, MetricsConfig, OversizeHandlerType, PathConfig, RSyncConfig, RepoConfig, Config, SecretsConfig, StorageConfig, SyncConfig
 
 LOG_LEVEL = get_env("LOG_LEVEL", True, '20', int)
 if LOG_LEVEL < 6:
@@ -20,8 +20,10 @@ _root_logger.setLevel(LOG_LEVEL)
 
 handler = StreamHandler(sys.stdout)
 handler.setLevel(LOG_LEVEL)
-formatter = Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+formatter = Formatter('%(asctime)s - %(name)s%(context)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
+handler.addFilter(ContextFilter())
+handler.addFilter(RedactFilter())
 _root_logger.addHandler(handler)
 
 log = get_logger('config')
@@ -42,10 +44,28 @@ DEFAULT_API_BASE = 'https://api.github.com'
 DEFAULT_ENDPOINT = 'https://github.com'
 DEFAULT_COMPRESSION = 'zip'
 DEFAULT_INTERVAL = 1440
+DEFAULT_JITTER = 0
+DEFAULT_WATCH = 0 # off
 DEFAULT_COMMIT_MESSAGE = 'chore(backup): update backup'
 DEFAULT_GIT_EMAIL = 'bot@backup.example'
 DEFAULT_GIT_NAME = 'Backup (bot)'
+DEFAULT_PUSH_WINDOW = 0 # push every cycle
 DEFAULT_MAX_FILE_SIZE = 50 * 1024 * 1024 # 50MB
+DEFAULT_CHUNKING_MODE = 'fixed'
+DEFAULT_CHUNK_AVG_SIZE = 4 * 1024 * 1024 # 4MB
+DEFAULT_CHUNK_BUFFER_SIZE = 1024 * 1024 # 1MB
+DEFAULT_CHUNK_WORKERS = 1
+DEFAULT_ARCHIVE_DETERMINISTIC = False
+DEFAULT_ARCHIVE_THREADS = 0 # all cores
+DEFAULT_ARCHIVE_STREAM = False
+DEFAULT_SYNC_WORKERS = 1
+DEFAULT_SYNC_PER_HOST = 0 # unlimited
+DEFAULT_SYNC_INDEX = False
+DEFAULT_SYNC_WORKTREES = False
+DEFAULT_SYNC_BRANCH_WORKERS = 1
+DEFAULT_SYNC_TIMEOUT = 0 # no limit
+DEFAULT_SYNC_PIPELINE = 0 # off
+DEFAULT_METRICS_PORT = 0 # off
 
 def make_path_config(path_str: str, branch: str = "main", compress: CompressType = None) -> PathConfig:
     spl = path_str.split(':')
@@ -64,9 +84,14 @@ def make_git_config() -> GitConfig:
     commit = get_env('GIT_COMMIT', True, '1', bool)
     push = get_env('GIT_PUSH', True, '1', bool)
     force_push = get_env('GIT_FORCE_PUSH', True, '0', bool)
+    push_window = get_env('GIT_PUSH_WINDOW', True, f'{DEFAULT_PUSH_WINDOW}', float)
     message = get_env('GIT_MESSAGE', True, DEFAULT_COMMIT_MESSAGE, str)
     email = get_env('GIT_EMAIL', True, DEFAULT_GIT_EMAIL)
     name = get_env('GIT_NAME', True, DEFAULT_GIT_NAME)
+    clone_filter = get_env('GIT_CLONE_FILTER', True)
+    sparse = get_env('GIT_SPARSE', True, '0', bool)
+    credential_helper = get_env('GIT_CREDENTIAL_HELPER', True, '0', bool)
+    many_files = get_env('GIT_MANY_FILES', True, '0', bool)
     
     
     return {
@@ -74,9 +99,27 @@ def make_git_config() -> GitConfig:
         "commit": commit,
         "push": push,
         "force_push": force_push,
+        "push_window": push_window,
         "message": message,
         "name": name,
-        "email": email
+        "email": email,
+        "clone_filter": clone_filter,
+        "sparse": sparse,
+        "credential_helper": credential_helper,
+        "many_files": many_files
+    }
+
+def make_chunking_config() -> ChunkingConfig:
+    mode = get_env('CHUNKING_MODE', True, DEFAULT_CHUNKING_MODE)
+    avg_size = get_env('CHUNK_AVG_SIZE', True, f'{DEFAULT_CHUNK_AVG_SIZE}', int)
+    buffer_size = get_env('CHUNK_BUFFER_SIZE', True, f'{DEFAULT_CHUNK_BUFFER_SIZE}', int)
+    workers = get_env('CHUNK_WORKERS', True, f'{DEFAULT_CHUNK_WORKERS}', int)
+    
+    return {
+        "mode": mode,
+        "avg_size": avg_size,
+        "buffer_size": buffer_size,
+        "workers": workers
     }
 
 def make_repo_config(
@@ -102,20 +145,26 @@ def make_repo_config(
         "paths": [make_path_config(p, branch, compress) for p in paths],
         "git": make_git_config(),
         "max_file_size": max_file_size,
-        "oversize_handler": oversize_handler_t
+        "oversize_handler": oversize_handler_t,
+        "chunking": make_chunking_config()
     }
     
 def make_loop_config() -> LoopConfig:
     loop = get_env('LOOP', True, True, bool)
     interval = get_env('LOOP_INTERVAL', True, DEFAULT_INTERVAL, float)
     schedule = get_env('LOOP_SCHEDULE', True)
+    jitter = get_env('LOOP_JITTER', True, DEFAULT_JITTER, float)
+    watch = get_env('LOOP_WATCH', True, DEFAULT_WATCH, float)
     
     loop_conf = {
         "loop": loop,
-        "interval": interval
+        "interval": interval,
+        "jitter": jitter,
+        "watch": watch
     }
     if schedule is not None:
-        loop_conf['schedule'] = Cron(schedule)
+        # a string, so it can be dumped to config.yaml. hydrated by `validate_conf()`
+        loop_conf['schedule'] = schedule
     return loop_conf
 
 def make_storage_config() -> StorageConfig:
@@ -127,9 +176,54 @@ def make_storage_config() -> StorageConfig:
     
 def make_rsync_config() -> RSyncConfig:
     archive = get_env('RSYNC_ARCHIVE', True, '1', bool)
+    delete = get_env('RSYNC_DELETE', True, '0', bool)
+    reflink = get_env('RSYNC_REFLINK', True, '0', bool)
     
     return {
-        "archive": archive
+        "archive": archive,
+        "delete": delete,
+        "reflink": reflink
+    }
+
+def make_archive_config() -> ArchiveConfig:
+    deterministic = get_env('ARCHIVE_DETERMINISTIC', True, '1' if DEFAULT_ARCHIVE_DETERMINISTIC else '0', bool)
+    level = get_env('ARCHIVE_LEVEL', True, None)
+    threads = get_env('ARCHIVE_THREADS', True, f'{DEFAULT_ARCHIVE_THREADS}', int)
+    stream = get_env('ARCHIVE_STREAM', True, '1' if DEFAULT_ARCHIVE_STREAM else '0', bool)
+    
+    return {
+        "deterministic": deterministic,
+        "level": int(level) if level else None,
+        "threads": threads,
+        "stream": stream
+    }
+
+def make_sync_config() -> SyncConfig:
+    workers = get_env('SYNC_WORKERS', True, f'{DEFAULT_SYNC_WORKERS}', int)
+    per_host = get_env('SYNC_PER_HOST', True, f'{DEFAULT_SYNC_PER_HOST}', int)
+    index = get_env('SYNC_INDEX', True, '1' if DEFAULT_SYNC_INDEX else '0', bool)
+    worktrees = get_env('SYNC_WORKTREES', True, '1' if DEFAULT_SYNC_WORKTREES else '0', bool)
+    branch_workers = get_env('SYNC_BRANCH_WORKERS', True, f'{DEFAULT_SYNC_BRANCH_WORKERS}', int)
+    timeout = get_env('SYNC_TIMEOUT', True, f'{DEFAULT_SYNC_TIMEOUT}', float)
+    pipeline = get_env('SYNC_PIPELINE', True, f'{DEFAULT_SYNC_PIPELINE}', int)
+    
+    return {
+        "workers": workers,
+        "per_host": per_host,
+        "index": index,
+        "worktrees": worktrees,
+        "branch_workers": branch_workers,
+        "timeout": timeout,
+        "pipeline": pipeline
+    }
+
+def make_metrics_config() -> MetricsConfig:
+    port = get_env('METRICS_PORT', True, f'{DEFAULT_METRICS_PORT}', int)
+    textfile = get_env('METRICS_TEXTFILE', True)
+    
+    return {
+        "port": port,
+        "textfile": textfile
     }
 
     
@@ -153,6 +247,9 @@ def bootstrap() -> Config:
         "version": VERSION,
         "storage": storage_config,
         "rsync": make_rsync_config(),
+        "archive": make_archive_config(),
+        "sync": make_sync_config(),
+        "metrics": make_metrics_config(),
         "repos": [make_repo_config(storage_config, compress)],
         "loop": make_loop_config()
     }
@@ -199,50 +296,298 @@ def bootstrap_secrets(default_repo: RepoConfig) -> SecretsConfig:
             yaml.dump(data, stream, default_flow_style=False, allow_unicode=True)
     return data
 
-def hydrate_conf(conf: Config) -> Config:
-    log.info('hydrate_conf()')
+class Required:
+    """
+    Schema of a key `validate_conf()` wants present, and unless `nullable` not null
+    """
+    def __init__(self, schema: Any, nullable: bool = False) -> None:
+        self.schema = schema
+        self.nullable = nullable
 
-    if 'schedule' in conf['loop']:
-        if not isinstance(conf['loop']['schedule'], (str, Cron)):
-            log.error(f'invalid schedule type, ignoring')
-        else:
-            log.info(f'hydrating schedule: \'{conf["loop"]["schedule"]}\'')
-            conf['loop']['schedule'] = Cron(conf['loop']['schedule'])
-    return conf
-    
-def _load_conf():
+def _literals(t: Any) -> frozenset:
+    # values of a Union of Literals from git_backup.types
+    return frozenset(value for literal in get_args(t) for value in get_args(literal))
+
+def _schedule(value: Any) -> Cron:
+    if isinstance(value, Cron):
+        return value
+    if not isinstance(value, str):
+        raise ValueError(f'expected a crontab expression, got {value!r}')
+    return Cron(value)
+
+def _oversize_handler(value: Any) -> OversizeHandlerType:
+    if value == 'chunk':
+        # what the types used to call it
+        log.warning("validate_conf() oversize_handler 'chunk' is deprecated, use 'chunking'")
+        return 'chunking'
+    if value not in _literals(OversizeHandlerType):
+        raise ValueError(f'expected one of {", ".join(sorted(_literals(OversizeHandlerType)))}, got {value!r}')
+    return value
+
+Number = (int, float)
+
+# A type or tuple of types is checked with isinstance(), a frozenset lists the allowed
+# values, a dict is a section and a list of one schema a list of them. Functions
+# convert the value, raising ValueError if they can't. Null is fine unless `Required`.
+PATH_SCHEMA = {
+    "local": Required(str),
+    "remote": Required(str),
+    "compress": Required(_literals(CompressType), nullable=True),
+    "branch": str,
+    "schedule": _schedule,
+    "interval": Number
+}
+
+GIT_SCHEMA = {
+    "add": bool,
+    "commit": bool,
+    "push": bool,
+    "force_push": bool,
+    "push_window": Number,
+    "message": str,
+    "email": str,
+    "name": str,
+    "clone_filter": str,
+    "sparse": bool,
+    "credential_helper": bool,
+    "many_files": bool
+}
+
+CHUNKING_SCHEMA = {
+    "mode": _literals(ChunkerType),
+    "avg_size": int,
+    "buffer_size": int,
+    "workers": int
+}
+
+REPO_SCHEMA = {
+    "name": Required(str),
+    "owner": Required(str),
+    "storage_root": str,
+    "endpoint": str,
+    "api_base": str,
+    "paths": Required([PATH_SCHEMA]),
+    "branch": Required(str),
+    "git": Required(GIT_SCHEMA),
+    "max_file_size": Required(int),
+    "oversize_handler": Required(_oversize_handler),
+    "chunking": CHUNKING_SCHEMA,
+    "schedule": _schedule,
+    "interval": Number
+}
+
+CONF_SCHEMA = {
+    "version": int,
+    "storage": {
+        "repo_root": str
+    },
+    "rsync": Required({
+        "archive": Required(bool),
+        "delete": bool,
+        "reflink": bool
+    }),
+    "archive": {
+        "deterministic": bool,
+        "level": int,
+        "threads": int,
+        "stream": bool
+    },
+    "sync": {
+        "workers": int,
+        "per_host": int,
+        "index": bool,
+        "worktrees": bool,
+        "branch_workers": int,
+        "timeout": Number,
+        "pipeline": int
+    },
+    "metrics": {
+        "port": int,
+        "textfile": str
+    },
+    "repos": Required([REPO_SCHEMA]),
+    "loop": Required({
+        "loop": Required(bool),
+        "interval": Number, # required without a schedule, see `validate_conf()`
+        "schedule": _schedule,
+        "jitter": Number,
+        "watch": Number
+    })
+}
+
+def _validate(value: Any, schema: Any, where: str, errors: List[str]) -> Any:
+    """
+    Check `value` against `schema`, appending what's wrong to `errors`, returns the
+    value with conversions applied
+    """
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            errors.append(f'{where}: expected a mapping, got {value!r}')
+            return value
+        for key, sub_schema in schema.items():
+            if isinstance(sub_schema, Required) and value.get(key) is None and not (sub_schema.nullable and key in value):
+                errors.append(f'{where}.{key}: missing')
+        for key, item in value.items():
+            key_where = f'{where}.{key}'
+            if key not in schema:
+                log.warning(f'validate_conf() unknown key {key_where}, ignoring')
+                continue
+            if item is not None:
+                value[key] = _validate(item, schema[key], key_where, errors)
+        return value
+    if isinstance(schema, Required):
+        return _validate(value, schema.schema, where, errors)
+    if isinstance(schema, list):
+        if not isinstance(value, list):
+            errors.append(f'{where}: expected a list, got {value!r}')
+            return value
+        for i, item in enumerate(value):
+            value[i] = _validate(item, schema[0], f'{where}[{i}]', errors)
+        return value
+    if isinstance(schema, frozenset):
+        if value not in schema:
+            errors.append(f'{where}: expected one of {", ".join(sorted(schema))}, got {value!r}')
+        return value
+    if isinstance(schema, (type, tuple)):
+        types = schema if isinstance(schema, tuple) else (schema,)
+        # yaml's true/false are ints to isinstance()
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            errors.append(f'{where}: expected {" or ".join(t.__name__ for t in types)}, got {value!r}')
+        return value
     try:
-        stream = open(CONF_PATH, "r")
-    except IOError as e:
-        if e.errno != 2: # not "file does not exist"
-            log.error(f'ERROR: _load_conf() failed to open config file: {e}')
-            raise e
-        return bootstrap()
+        return schema(value)
+    except ValueError as e:
+        errors.append(f'{where}: {e}')
+        return value
+
+def validate_conf(conf: Any) -> Config:
+    """
+    Check the whole config against `CONF_SCHEMA` in a single pass, hydrating
+    schedules on the way, and raise with every problem found rather than the first
+    """
+    log.info('validate_conf()')
+    errors: List[str] = []
+    conf = _validate(conf, CONF_SCHEMA, 'config', errors)
+    loop = conf.get('loop') if isinstance(conf, dict) else None
+    # a single run, or a schedule, needs no interval
+    if isinstance(loop, dict) and loop.get('loop') and loop.get('schedule') is None and loop.get('interval') is None:
+        errors.append('config.loop.interval: missing, required by loop.loop without loop.schedule')
+    if errors:
+        for error in errors:
+            log.error(f'ERROR: validate_conf() {error}')
+        raise ValueError(f'Invalid config: {"; ".join(errors)}')
+    return conf
+
+def validate_secrets(secrets: Any) -> SecretsConfig:
+    """
+    Check secrets are `{ owner -> { repo -> { key -> value }}}`, next to a `version`
+    """
+    errors: List[str] = []
+    if not isinstance(secrets, dict):
+        errors.append(f'expected a mapping, got {secrets!r}')
+    else:
+        for owner, repos in secrets.items():
+            if owner == 'version':
+                continue
+            if not isinstance(repos, dict) or not all(isinstance(repo, dict) for repo in repos.values()):
+                errors.append(f'{owner}: expected a mapping of repos to their secrets')
+    if errors:
+        for error in errors:
+            log.error(f'ERROR: validate_secrets() {error}')
+        raise ValueError(f'Invalid secrets: {"; ".join(errors)}')
+    return secrets
+
+# (mtime_ns, size, inode)
+Stamp = Tuple[int, int, int]
+
+# path -> (stamp, parsed contents), reused while the file's stamp is unchanged
+_cache: Dict[str, Tuple[Stamp, Any]] = {}
+
+def file_stamp(path: str) -> Optional[Stamp]:
+    """
+    What changes when `path` is written or replaced, None if it doesn't exist
+    """
     try:
-        conf = yaml.safe_load(stream)
-        conf = hydrate_conf(conf)
-        return conf
-    except yaml.YAMLError as e:
-        log.error(f'ERROR: _load_conf() Error reading config: {e}')
-        raise ValueError(f"Error reading config: {e}")
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
 
-def _load_secrets(conf: Config) -> SecretsConfig:
+def _read_yaml(path: str, what: str, parse: Callable[[Any], Any]) -> Optional[Any]:
+    """
+    The YAML file at `path` passed through `parse()`, None if it doesn't exist
+
+    Parsed once per version of the file, later calls return the same object as long as
+    its stamp is unchanged.
+    """
+    # taken before reading, so a write racing the read is picked up by the next call
+    stamp = file_stamp(path)
+    cached = _cache.get(path)
+    if stamp is not None and cached is not None and cached[0] == stamp:
+        return cached[1]
     try:
-        stream = open(SECRETS_PATH, "r")
+        stream = open(path, "r")
     except IOError as e:
         if e.errno != 2: # not "file does not exist"
-            log.error(f'ERROR: _load_secrets() failed to open secrets file: {e}')
+            log.error(f'ERROR: _read_yaml() failed to open {what} file: {e}')
             raise e
+        return None
+    with stream:
+        try:
+            data = yaml.safe_load(stream)
+        except yaml.YAMLError as e:
+            log.error(f'ERROR: _read_yaml() Error reading {what}: {e}')
+            raise ValueError(f"Error reading {what}: {e}")
+    value = parse(data)
+    _cache[path] = (stamp, value)
+    return value
+
+def _load_conf() -> Config:
+    conf = _read_yaml(CONF_PATH, 'config', validate_conf)
+    if conf is None:
+        return validate_conf(bootstrap())
+    return conf
+
+def _load_secrets(conf: Config) -> SecretsConfig:
+    secrets = _read_yaml(SECRETS_PATH, 'secrets', validate_secrets)
+    if secrets is None:
         default_repo = conf['repos'][0]
         return bootstrap_secrets(default_repo)
-    try:
-        return yaml.safe_load(stream)
-    except yaml.YAMLError as e:
-        log.error(f'ERROR: _load_secrets() Error reading secrets: {e}')
-        raise ValueError(f"Error reading secrets: {e}")
+    return secrets
 
 def load() -> Config:
     log.info('load()')
-    conf = _load_conf()
+    # a copy, the cached config is shared with whoever loaded it before
+    conf = {**_load_conf()}
     conf['secrets'] = Secrets(_load_secrets(conf))
-    return conf
\ No newline at end of file
+    return conf
+
+class ConfigWatcher:
+    """
+    Notices changes to config.yaml and secrets.yaml by polling their stamps
+    """
+    def __init__(self) -> None:
+        self.stamps = self._stamps()
+
+    def _stamps(self) -> Tuple[Optional[Stamp], Optional[Stamp]]:
+        return (file_stamp(CONF_PATH), file_stamp(SECRETS_PATH))
+
+    def poll(self) -> Optional[Config]:
+        """
+        Freshly loaded config if either file changed since the last poll, None if
+        neither did or the new config is invalid, keeping the current one
+        """
+        stamps = self._stamps()
+        if stamps == self.stamps:
+            return None
+        if any(old is not None and new is None for old, new in zip(self.stamps, stamps)):
+            # mid-save, or deleted. bootstrapping from env could overwrite it, try again later
+            log.warning('poll() config or secrets file missing, keeping the current config')
+            return None
+        self.stamps = stamps
+        log.info('poll() config changed, reloading')
+        try:
+            return load()
+        except Exception as e:
+            log.error(f'ERROR: poll() keeping the current config, failed to load the new one: {e}')
+            return None
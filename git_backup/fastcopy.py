@@ -0,0 +1,215 @@
+import errno
+import fcntl
+import os
+import stat
+from typing import Callable, Dict, List, Optional, Set
+
+from git_backup.types import ChangeSet
+
+# ioctl sharing the source's extents with the destination, btrfs/xfs/overlayfs on either
+FICLONE = 0x40049409
+
+# strategies in order of preference, each falls back to the next
+STRATEGIES = ('reflink', 'copy_file_range', 'sendfile', 'read')
+
+# errors meaning "not supported here" rather than a failed copy
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF}
+
+BUFFER_SIZE = 1024 * 1024
+
+def same_filesystem(src: str, dest: str) -> bool:
+    """
+    Whether `src` and the existing `dest` directory are on the same filesystem
+    """
+    try:
+        return os.stat(src).st_dev == os.stat(dest).st_dev
+    except OSError:
+        return False
+
+def _reflink(src_fd: int, dst_fd: int, size: int):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+def _copy_file_range(src_fd: int, dst_fd: int, size: int):
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+        if copied == 0:
+            break
+        offset += copied
+
+def _sendfile(src_fd: int, dst_fd: int, size: int):
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+        if sent == 0:
+            break
+        offset += sent
+
+def _read(src_fd: int, dst_fd: int, size: int):
+    offset = 0
+    while True:
+        data = os.pread(src_fd, BUFFER_SIZE, offset)
+        if not data:
+            break
+        os.write(dst_fd, data)
+        offset += len(data)
+
+_COPY: Dict[str, Callable[[int, int, int], None]] = {
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range,
+    "sendfile": _sendfile,
+    "read": _read
+}
+
+def copy_file(src: str, dst: str, size: int, start: str = STRATEGIES[0]) -> str:
+    """
+    Copy `src` to `dst` with the first strategy from `start` on that works, returns it
+
+    The data lands in a temporary file next to `dst` that replaces it once complete,
+    so a reflinked or partial copy never shows up in place of the old file.
+    """
+    tmp_path = os.path.join(os.path.dirname(dst), f'.{os.path.basename(dst)}.fastcopy')
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            for strategy in STRATEGIES[STRATEGIES.index(start):]:
+                try:
+                    _COPY[strategy](src_fd, dst_fd, size)
+                    break
+                except OSError as e:
+                    if strategy == STRATEGIES[-1] or e.errno not in _UNSUPPORTED:
+                        raise
+                    # start the next strategy from a clean file
+                    os.ftruncate(dst_fd, 0)
+                    os.lseek(dst_fd, 0, os.SEEK_SET)
+        finally:
+            os.close(dst_fd)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        os.close(src_fd)
+    return strategy
+
+def _copy_attrs(src_st: os.stat_result, dst: str):
+    # what `rsync -a` keeps: permissions, times and, as root, ownership
+    if os.geteuid() == 0:
+        os.chown(dst, src_st.st_uid, src_st.st_gid, follow_symlinks=False)
+    if not stat.S_ISLNK(src_st.st_mode):
+        os.chmod(dst, stat.S_IMODE(src_st.st_mode))
+    os.utime(dst, ns=(src_st.st_atime_ns, src_st.st_mtime_ns), follow_symlinks=False)
+
+def _sync_link(src: str, dst: str, dst_st: Optional[os.stat_result]) -> bool:
+    target = os.readlink(src)
+    if dst_st is not None:
+        if stat.S_ISLNK(dst_st.st_mode) and os.readlink(dst) == target:
+            return False
+        os.remove(dst)
+    os.symlink(target, dst)
+    return True
+
+def _lstat(path: str) -> Optional[os.stat_result]:
+    try:
+        return os.lstat(path)
+    except FileNotFoundError:
+        return None
+
+def _prune(dest: str, keep_files: Set[str], keep_dirs: Set[str], protect: Callable[[str, bool], bool], changes: ChangeSet):
+    """
+    Delete what's in `dest` but not in the source, like `rsync --delete`
+    """
+    stack = [('', dest)]
+    dirs: List[str] = []
+    while stack:
+        rel_dir, dir_path = stack.pop()
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                rel = f'{rel_dir}{entry.name}'
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if protect(rel, is_dir):
+                    continue
+                if is_dir:
+                    stack.append((f'{rel}/', entry.path))
+                    dirs.append(rel)
+                elif rel not in keep_files:
+                    os.remove(entry.path)
+                    changes['deleted'].append(rel)
+    # children come after their parents, remove them first
+    for rel in reversed(dirs):
+        if rel not in keep_dirs:
+            try:
+                os.rmdir(os.path.join(dest, rel))
+            except OSError:
+                # still holds protected files
+                pass
+
+def sync_tree(
+    src: str,
+    dest: str,
+    changes: ChangeSet,
+    archive: bool = True,
+    delete: bool = False,
+    protect: Callable[[str, bool], bool] = lambda rel, is_dir: False
+) -> Dict[str, int]:
+    """
+    Bring `dest` up to date with the file or directory `src`, recording into `changes`
+    like `rsync` itemizes its changes, returns the number of files copied per strategy
+
+    Files whose size and mtime match are skipped, as rsync's quick check does. With
+    `archive`, permissions, times and symlinks are kept as `rsync -a` would, otherwise
+    symlinks are skipped. With `delete`, files missing from `src` are removed from
+    `dest` unless `protect(rel, is_dir)` says to keep them. Directories are created
+    even when empty, as rsync does, git just doesn't track them.
+    """
+    counts: Dict[str, int] = {}
+    strategy = STRATEGIES[0]
+
+    def _sync_file(path: str, src_st: os.stat_result, dst: str, rel: str):
+        nonlocal strategy
+        dst_st = _lstat(dst)
+        if stat.S_ISLNK(src_st.st_mode):
+            if not archive or not _sync_link(path, dst, dst_st):
+                return
+        elif not stat.S_ISREG(src_st.st_mode):
+            # devices, sockets and fifos, `rsync -a` skips them too
+            return
+        elif (
+            dst_st is not None and stat.S_ISREG(dst_st.st_mode)
+            and dst_st.st_size == src_st.st_size and dst_st.st_mtime_ns == src_st.st_mtime_ns
+        ):
+            return
+        else:
+            # once a strategy is unsupported for one file, later files skip it
+            strategy = copy_file(path, dst, src_st.st_size, strategy)
+            counts[strategy] = counts.get(strategy, 0) + 1
+        if archive:
+            _copy_attrs(src_st, dst)
+        (changes['added'] if dst_st is None else changes['modified']).append(rel)
+
+    if not os.path.isdir(src):
+        _sync_file(src, os.lstat(src), dest, os.path.basename(dest))
+        return counts
+
+    keep_files: Set[str] = set()
+    keep_dirs: Set[str] = set()
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        dst_dir = os.path.join(dest, rel_dir)
+        os.makedirs(dst_dir, exist_ok=True)
+        with os.scandir(os.path.join(src, rel_dir)) as it:
+            for entry in it:
+                rel = f'{rel_dir}{entry.name}'
+                if entry.is_dir(follow_symlinks=False):
+                    keep_dirs.add(rel)
+                    stack.append(f'{rel}/')
+                    continue
+                keep_files.add(rel)
+                _sync_file(entry.path, entry.stat(follow_symlinks=False), os.path.join(dst_dir, entry.name), rel)
+
+    if delete:
+        _prune(dest, keep_files, keep_dirs, protect, changes)
+    return counts
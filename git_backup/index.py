@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+from typing import Any, Optional
+
+from git_backup.logger import get_logger
+from git_backup.types import ChangeSet, PathConfig, Snapshot
+from git_backup.walk import walk
+
+log = get_logger('index')
+
+INDEX_VERSION = 1
+
+def index_key(path: PathConfig, *settings: Any) -> str:
+    """
+    Stable key for a path config, changing any of its fields, or any of `settings`,
+    starts a fresh index
+    """
+    ident = '\0'.join([path['local'], path['remote'], str(path.get('compress')), str(path.get('branch')), *map(str, settings)])
+    return hashlib.sha1(ident.encode('utf8')).hexdigest()
+
+def _entry(st: os.stat_result) -> list:
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+def scan(local_path: str) -> Snapshot:
+    """
+    Snapshot mtime/size/inode of every file below `local_path`, keyed by path relative to it
+
+    A single file is keyed by its basename.
+    """
+    snapshot: Snapshot = {}
+    if not os.path.isdir(local_path):
+        snapshot[os.path.basename(local_path)] = _entry(os.stat(local_path))
+        return snapshot
+
+    prefix = len(os.path.join(local_path, ''))
+    for path, st in walk(local_path, skip=(), follow_symlinks=False):
+        snapshot[path[prefix:]] = _entry(st)
+    return snapshot
+
+def diff(prev: Snapshot, cur: Snapshot) -> ChangeSet:
+    added = []
+    modified = []
+    for rel, entry in cur.items():
+        prev_entry = prev.get(rel)
+        if prev_entry is None:
+            added.append(rel)
+        elif list(prev_entry) != entry:
+            modified.append(rel)
+    deleted = [rel for rel in prev if rel not in cur]
+
+    return {
+        "added": sorted(added),
+        "modified": sorted(modified),
+        "deleted": sorted(deleted)
+    }
+
+def is_empty(changes: ChangeSet) -> bool:
+    return not (changes['added'] or changes['modified'] or changes['deleted'])
+
+def load(state_dir: str, key: str) -> Optional[Snapshot]:
+    index_path = os.path.join(state_dir, 'index', f'{key}.json')
+    try:
+        with open(index_path, 'r', encoding='utf8') as stream:
+            data = json.load(stream)
+    except IOError as e:
+        if e.errno != 2: # not "file does not exist"
+            log.warning(f'load() could not read index {index_path}: {e}')
+        return None
+    except ValueError as e:
+        log.warning(f'load() ignoring corrupt index {index_path}: {e}')
+        return None
+
+    if data.get('version') != INDEX_VERSION:
+        return None
+    return data['files']
+
+def save(state_dir: str, key: str, snapshot: Snapshot):
+    index_dir = os.path.join(state_dir, 'index')
+    os.makedirs(index_dir, exist_ok=True)
+
+    index_path = os.path.join(index_dir, f'{key}.json')
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as stream:
+        json.dump({"version": INDEX_VERSION, "files": snapshot}, stream, separators=(',', ':'))
+    os.replace(tmp_path, index_path)
\ No newline at end of file
@@ -1,9 +1,56 @@
-from logging import Logger, getLogger
+from contextlib import contextmanager
+from contextvars import ContextVar
+import re
+from logging import Filter, Logger, LogRecord, getLogger
+from typing import Iterator, Optional
 
 PREFIX = 'git_backup'
 
+# userinfo of a URL, eg. the token in `https://<token>@github.com/...`
+_CREDENTIALS = re.compile(r'(\b[a-zA-Z][\w+.-]*://)[^/@\s]+@')
+
+# name of the unit of work (eg. `owner/repo`) the current thread is handling
+_context: ContextVar[Optional[str]] = ContextVar('git_backup_log_context', default=None)
+
 def get_root_logger() -> Logger:
     return getLogger(f'{PREFIX}')
 
 def get_logger(name: str) -> Logger:
-    return getLogger(f'{PREFIX}.{name}')
\ No newline at end of file
+    return getLogger(f'{PREFIX}.{name}')
+
+@contextmanager
+def log_context(name: str) -> Iterator[None]:
+    """
+    Tag every record logged from the current thread/task with `name`
+    """
+    token = _context.set(name)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+class ContextFilter(Filter):
+    """
+    Populates `%(context)s` with the active `log_context()`, if any
+    """
+    def filter(self, record: LogRecord) -> bool:
+        ctx = _context.get()
+        record.context = f' [{ctx}]' if ctx else ''
+        return True
+
+def redact(text: str) -> str:
+    """
+    Mask credentials embedded in URLs
+    """
+    return _CREDENTIALS.sub(r'\1***@', text)
+
+class RedactFilter(Filter):
+    """
+    Masks credentials in every record before it is formatted
+    """
+    def filter(self, record: LogRecord) -> bool:
+        message = record.getMessage()
+        redacted = redact(message)
+        if redacted != message:
+            record.msg, record.args = redacted, None
+        return True
@@ -2,8 +2,10 @@ from time import sleep
 import traceback
 from typing import Any, Callable, List
 
-from git_backup.config import load
-from git_backup.sync import sync
+from git_backup import metrics
+from git_backup.config import ConfigWatcher, load
+from git_backup.scheduler import Scheduler
+from git_backup.sync import get_metrics_config, sync
 from git_backup.logger import get_logger
 
 log = get_logger('main')
@@ -16,6 +18,7 @@ def backoff(fn: Callable, args: List[Any], timeout: int = 60*60, delay: int = 10
             return fn(*args)
         except Exception as e:
             log.error(f'ERROR: back_off({attempt}) Unhandled exception: \n{traceback.format_exc()}')
+            metrics.inc('git_backup_retries_total')
             attempt += 1
             delay *= 2
             timer += delay
@@ -26,34 +29,29 @@ def backoff(fn: Callable, args: List[Any], timeout: int = 60*60, delay: int = 10
 
 def run():
     log.info('starting up')
+    # before loading, so a change made meanwhile isn't missed
+    watcher = ConfigWatcher()
     conf = load()
     log.info('loaded config')
     
+    metrics_conf = get_metrics_config(conf)
+    if metrics_conf['port']:
+        metrics.serve(metrics_conf['port'])
+    
     loop = conf['loop']
     
     if not loop['loop']:
         log.info('running single sync')
         backoff(sync, [conf])
     else:
-        scheduled = 'schedule' in loop
-        if scheduled:
+        if loop.get('schedule') is not None:
             log.info(f'running on schedule: {loop["schedule"].crontab}')
         else:
             log.info(f'running in loop every {loop["interval"]} minutes')
-            
-        while True:   
-            if scheduled:
-                t = loop['schedule'].next()
-                log.info(f'next sync in {t} seconds')
-                sleep(t)
-                log.info('start sync')
-                backoff(sync, [conf])
-            else:
-                log.info('start sync')
-                backoff(sync, [conf])
-                t = loop['interval']*60
-                log.info(f'next sync in {t} seconds')
-                sleep(t)
+        if loop.get('watch'):
+            log.info(f'watching config for changes every {loop["watch"]} seconds')
+        # repos (and paths with their own schedule) are synced whenever each is due
+        Scheduler(conf, watcher.poll).run()
 
 if __name__ == "__main__":
     run()
\ No newline at end of file
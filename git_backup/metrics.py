@@ -0,0 +1,140 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+from git_backup.logger import get_logger
+
+log = get_logger('metrics')
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# name -> (type, help), in exposition order
+METRICS: Dict[str, Tuple[str, str]] = {
+    "git_backup_stage_seconds": ('summary', 'Time spent in each stage of a sync'),
+    "git_backup_bytes_total": ('counter', 'Bytes transferred by rsync, archived or chunked'),
+    "git_backup_copied_files_total": ('counter', 'Files copied without rsync, by strategy'),
+    "git_backup_subprocesses_total": ('counter', 'Commands spawned'),
+    "git_backup_repo_failures_total": ('counter', 'Repo syncs that failed'),
+    "git_backup_retries_total": ('counter', 'Sync cycles retried after an error'),
+    "git_backup_repo_last_sync_seconds": ('gauge', 'Duration of the last sync of each repo'),
+    "git_backup_repo_last_success_timestamp_seconds": ('gauge', 'Unix time each repo last synced without failing'),
+    "git_backup_cycle_seconds": ('gauge', 'Duration of the last sync cycle'),
+    "git_backup_last_success_timestamp_seconds": ('gauge', 'Unix time the last cycle finished without failures')
+}
+
+_lock = threading.Lock()
+# metric or sample name -> labels -> value
+_values: Dict[str, Dict[Labels, float]] = {}
+
+# labels added to everything recorded from the current thread/task, eg. the repo
+_labels: ContextVar[Labels] = ContextVar('git_backup_metric_labels', default=())
+
+@contextmanager
+def metric_labels(**labels: str) -> Iterator[None]:
+    """
+    Label every metric recorded from the current thread/task, like `log_context()` for logs
+    """
+    token = _labels.set(tuple({**dict(_labels.get()), **labels}.items()))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+def _key(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted({**dict(_labels.get()), **labels}.items()))
+
+def inc(name: str, value: float = 1, **labels: str):
+    key = _key(labels)
+    with _lock:
+        samples = _values.setdefault(name, {})
+        samples[key] = samples.get(key, 0) + value
+
+def set_gauge(name: str, value: float, **labels: str):
+    key = _key(labels)
+    with _lock:
+        _values.setdefault(name, {})[key] = value
+
+def observe(name: str, value: float, **labels: str):
+    inc(f'{name}_sum', value, **labels)
+    inc(f'{name}_count', 1, **labels)
+
+@contextmanager
+def timer(stage: str, **labels: str) -> Iterator[None]:
+    """
+    Record the time spent in the block as `stage`, whether or not it raises
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('git_backup_stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format(name: str, labels: Labels, value: float) -> str:
+    if labels:
+        name += '{' + ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels) + '}'
+    return f'{name} {value:g}' if isinstance(value, float) and not value.is_integer() else f'{name} {int(value)}'
+
+def render() -> str:
+    """
+    Everything recorded so far, in the Prometheus text exposition format
+    """
+    lines = []
+    with _lock:
+        for name, (metric_type, help) in METRICS.items():
+            names = [f'{name}_sum', f'{name}_count'] if metric_type == 'summary' else [name]
+            if not any(n in _values for n in names):
+                continue
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for sample_name in names:
+                for labels, value in sorted(_values.get(sample_name, {}).items()):
+                    lines.append(_format(sample_name, labels, value))
+    return ''.join(f'{line}\n' for line in lines)
+
+def write_textfile(path: str):
+    """
+    Write the metrics for node_exporter's textfile collector, atomically
+    """
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf8') as stream:
+            stream.write(render())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning(f'write_textfile() could not write metrics to {path}: {e}')
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the log
+        pass
+
+def serve(port: int, addr: str = '') -> Optional[ThreadingHTTPServer]:
+    """
+    Expose `/metrics` on `port` from a background thread
+    """
+    try:
+        server = ThreadingHTTPServer((addr, port), _Handler)
+    except OSError as e:
+        log.error(f'ERROR: serve() could not listen on port {port}: {e}')
+        return None
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log.info(f'serve() metrics on port {port}')
+    return server
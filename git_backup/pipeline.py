@@ -0,0 +1,64 @@
+import contextvars
+from queue import Queue
+import threading
+from typing import Any, Callable, Iterable, List, Optional
+
+# end of input, passed down from stage to stage
+_DONE = object()
+
+def run_pipeline(items: Iterable[Any], stages: List[Callable[[Any], Any]], depth: int = 1, name: str = 'stage') -> List[Any]:
+    """
+    Pass every item through `stages` in order, returns what the last stage returned
+
+    Each stage runs on its own thread, so different items are in different stages
+    at the same time, with at most `depth` items waiting between two stages. Every
+    stage sees the items in their original order. A stage returning None drops the
+    item. After the first exception the remaining items are drained without work
+    and the exception is raised once every stage has stopped.
+    """
+    inbox: Queue = Queue()
+    for item in items:
+        inbox.put(item)
+    inbox.put(_DONE)
+
+    results: List[Any] = []
+    errors: List[BaseException] = []
+
+    def _worker(fn: Callable[[Any], Any], inbox: Queue, outbox: Optional[Queue]):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            if errors:
+                # keep draining so upstream stages never block on a full queue
+                continue
+            try:
+                out = fn(item)
+            except BaseException as e:
+                errors.append(e)
+                continue
+            if out is None:
+                continue
+            if outbox is None:
+                results.append(out)
+            else:
+                outbox.put(out)
+        if outbox is not None:
+            outbox.put(_DONE)
+
+    threads = []
+    for i, fn in enumerate(stages):
+        outbox = Queue(maxsize=max(depth, 1)) if i < len(stages) - 1 else None
+        # a context can only be entered by one thread at a time, each stage gets a copy
+        ctx = contextvars.copy_context()
+        threads.append(threading.Thread(target=ctx.run, args=(_worker, fn, inbox, outbox), name=f'{name}-{i}', daemon=True))
+        inbox = outbox
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,153 @@
+import asyncio
+from asyncio.subprocess import PIPE
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Union
+
+from git_backup import metrics
+from git_backup.logger import get_logger, redact
+
+log = get_logger('proc')
+
+# longest line read from a streamed command, eg. a path in rsync's output
+LINE_LIMIT = 1024 * 1024
+
+# seconds a single command may run in the current thread/task, None for no limit
+_timeout: ContextVar[Optional[float]] = ContextVar('git_backup_command_timeout', default=None)
+
+@contextmanager
+def command_timeout(seconds: Optional[float]) -> Iterator[None]:
+    """
+    Limit every command run from the current thread/task to `seconds`, 0 or None for no limit
+    """
+    token = _timeout.set(seconds or None)
+    try:
+        yield
+    finally:
+        _timeout.reset(token)
+
+def _decode(data: bytes) -> str:
+    # undecodable bytes, eg. in file names, round trip back to the same path
+    return data.decode('utf8', 'surrogateescape')
+
+def command_name(cmd: List[str]) -> str:
+    """
+    Command and subcommand, eg. `git push` for `git -c a=b push -f origin`
+    """
+    args = iter(cmd[1:])
+    for arg in args:
+        if arg == '-c':
+            next(args, None)
+        elif not arg.startswith('-'):
+            return f'{os.path.basename(cmd[0])} {arg}'
+    return os.path.basename(cmd[0])
+
+def _env(extra: Optional[Dict[str, str]]) -> Optional[Dict[str, str]]:
+    # added to, rather than replacing, the inherited environment
+    return {**os.environ, **extra} if extra else None
+
+def _fail(cmd: List[str], error: str, log_error: bool):
+    # commands and their errors can carry credentials, eg. in a remote URL
+    message = redact(f'Failed to execute command: {" ".join(cmd)}. \nError: {error}')
+    if log_error:
+        log.error(f'ERROR: exec_sh() {message}')
+    raise RuntimeError(message)
+
+async def _kill(proc: asyncio.subprocess.Process):
+    if proc.returncode is None:
+        proc.kill()
+        await proc.wait()
+
+async def run(
+    cmd: List[str],
+    cwd: Optional[str] = None,
+    input: Optional[Union[str, bytes]] = None,
+    binary: bool = False,
+    timeout: Optional[float] = None,
+    log_error: bool = True,
+    env: Optional[Dict[str, str]] = None
+) -> Union[str, bytes]:
+    """
+    Run `cmd` to completion and return its stdout, as bytes if `binary`
+
+    Raises RuntimeError if it exits non-zero or runs over `timeout` seconds (defaults to
+    the active `command_timeout()`). Cancelling the awaiting task kills the process.
+    """
+    if timeout is None:
+        timeout = _timeout.get()
+    if isinstance(input, str):
+        input = input.encode('utf8', 'surrogateescape')
+
+    metrics.inc('git_backup_subprocesses_total', command=command_name(cmd))
+    proc = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, stdin=PIPE if input is not None else None, stdout=PIPE, stderr=PIPE, env=_env(env))
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(input), timeout)
+    except asyncio.TimeoutError:
+        await _kill(proc)
+        _fail(cmd, f'timed out after {timeout}s', log_error)
+    except asyncio.CancelledError:
+        await _kill(proc)
+        raise
+
+    if proc.returncode != 0:
+        _fail(cmd, _decode(stderr), log_error)
+    return stdout if binary else _decode(stdout)
+
+async def iter_lines(
+    cmd: List[str],
+    cwd: Optional[str] = None,
+    timeout: Optional[float] = None,
+    log_error: bool = True,
+    env: Optional[Dict[str, str]] = None
+) -> AsyncIterator[str]:
+    """
+    Yield lines of `cmd`'s stdout as they are written, without the trailing newline
+
+    Only one line is held at a time. Raises like `run()` once the output ends, leaving
+    the loop early kills the process.
+    """
+    if timeout is None:
+        timeout = _timeout.get()
+
+    metrics.inc('git_backup_subprocesses_total', command=command_name(cmd))
+    proc = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, stdout=PIPE, stderr=PIPE, limit=LINE_LIMIT, env=_env(env))
+    # drained alongside stdout so a chatty stderr can't fill its pipe and stall the command
+    stderr = asyncio.ensure_future(proc.stderr.read())
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout else None
+
+    def _remaining() -> Optional[float]:
+        return None if deadline is None else max(deadline - loop.time(), 0)
+
+    try:
+        while True:
+            line = await asyncio.wait_for(proc.stdout.readline(), _remaining())
+            if not line:
+                break
+            yield _decode(line.rstrip(b'\n'))
+        await asyncio.wait_for(proc.wait(), _remaining())
+        error = _decode(await stderr)
+    except asyncio.TimeoutError:
+        _fail(cmd, f'timed out after {timeout}s', log_error)
+    finally:
+        await _kill(proc)
+        stderr.cancel()
+
+    if proc.returncode != 0:
+        _fail(cmd, error, log_error)
+
+def run_sync(cmd: List[str], **kwargs) -> Union[str, bytes]:
+    """
+    Blocking `run()`, for callers outside an event loop (eg. worker threads)
+    """
+    return asyncio.run(run(cmd, **kwargs))
+
+def each_line(cmd: List[str], fn: Callable[[str], None], **kwargs):
+    """
+    Blocking `iter_lines()`, calling `fn` with each line as it arrives
+    """
+    async def _consume():
+        async for line in iter_lines(cmd, **kwargs):
+            fn(line)
+    asyncio.run(_consume())
@@ -0,0 +1,235 @@
+"""
+Reassemble chunked files from their `<file>.d/manifest`
+
+    python3 -m git_backup.restore [--out DIR] [--workers N] [--jobs N] [--force] PATH...
+
+Each PATH is a manifest, a `<file>.d` directory or a directory searched for them,
+eg. a checkout of the backup repo. Files are restored next to their `.d` directory,
+or below `--out` keeping their path relative to PATH. Existing files are left alone
+unless `--force` is given, eg. a current file next to stale chunks of an older version.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import sys
+from typing import Iterator, List, Optional, Tuple
+
+from git_backup.chunking import CHUNK_STORE_DIR, DEFAULT_BUFFER_SIZE, MANIFEST_NAME, read_manifest
+from git_backup.logger import get_logger
+from git_backup.types import Manifest
+from git_backup.walk import walk
+
+log = get_logger('restore')
+
+def chunk_paths(manifest_path: str, manifest: Manifest) -> List[str]:
+    """
+    Path of every chunk of `manifest`, in order
+    """
+    chunk_dir = os.path.dirname(manifest_path)
+    if manifest['chunker'] == 'cdc':
+        store_path = os.path.normpath(os.path.join(chunk_dir, manifest['store']))
+        return [os.path.join(store_path, oid.split(':', 1)[1][:2], oid.split(':', 1)[1]) for oid, _ in manifest['chunk_list']]
+    # manifests written before they listed their chunks only have the count
+    return [os.path.join(chunk_dir, str(i)) for i in range(len(manifest['chunk_list']) or manifest['chunks'])]
+
+def _fail(message: str):
+    log.error(f'ERROR: restore_file() {message}')
+    raise RuntimeError(message)
+
+def _read_chunk(path: str, size: int, buffer_size: int) -> Iterator[memoryview]:
+    """
+    Yield the contents of chunk `path` through a reused buffer, at most `size` bytes
+    """
+    view = memoryview(bytearray(min(buffer_size, max(size, 1))))
+    done = 0
+    with open(path, 'rb', buffering=0) as f:
+        while done < size:
+            n = f.readinto(view[:min(len(view), size - done)])
+            if not n:
+                break
+            yield view[:n]
+            done += n
+
+def _restore_chunk(fd: int, path: str, offset: int, entry: Tuple[Optional[str], int], buffer_size: int, file_hash=None) -> int:
+    """
+    Verify a single chunk and write it at `offset` of `fd`, updating `file_hash` if
+    given, returns its size. Chunks without an oid are only checked as part of the file
+    """
+    oid, size = entry
+    hash = hashlib.sha256()
+    done = 0
+    # one byte more than expected, to notice an oversized chunk
+    for piece in _read_chunk(path, size + 1, buffer_size):
+        hash.update(piece)
+        if file_hash is not None:
+            file_hash.update(piece)
+        os.pwrite(fd, piece, offset + done)
+        done += len(piece)
+    if done != size:
+        _fail(f'chunk {path} is {done} bytes, expected {size}')
+    if oid is not None and f'sha256:{hash.hexdigest()}' != oid:
+        _fail(f'chunk {path} does not match {oid}')
+    return done
+
+def _hash_chunks(paths: List[str], chunk_list: List[Tuple[Optional[str], int]], buffer_size: int) -> Tuple[str, int]:
+    hash = hashlib.sha256()
+    size = 0
+    for path, (_, chunk_size) in zip(paths, chunk_list):
+        for piece in _read_chunk(path, chunk_size, buffer_size):
+            hash.update(piece)
+            size += len(piece)
+    return f'sha256:{hash.hexdigest()}', size
+
+def _preallocate(fd: int, size: int):
+    if size <= 0:
+        return
+    try:
+        # reserves the blocks up front, so a full disk fails before writing anything
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # not supported by the platform or filesystem, just set the size
+        os.ftruncate(fd, size)
+
+def restore_file(manifest_path: str, dest: Optional[str] = None, workers: int = 1, buffer_size: int = DEFAULT_BUFFER_SIZE, force: bool = False) -> Manifest:
+    """
+    Reassemble the file described by `manifest_path` at `dest`, next to its `.d`
+    directory by default. An existing `dest` is refused unless `force`
+
+    The target is preallocated and chunks are written at their offsets by `workers`
+    threads, each chunk checked against its oid and size. The whole file's oid and
+    size are verified from a separate, in order, pass over the chunks (the same pass
+    as the writes with a single worker). Nothing replaces `dest` unless all of them match.
+    """
+    manifest = read_manifest(manifest_path)
+    if manifest is None:
+        _fail(f'could not read manifest {manifest_path}')
+    chunk_dir = os.path.dirname(manifest_path)
+    if dest is None:
+        dest = os.path.join(os.path.dirname(chunk_dir), manifest['name'])
+    if os.path.lexists(dest) and not force:
+        _fail(f'{dest} already exists, not overwriting it without --force')
+
+    paths = chunk_paths(manifest_path, manifest)
+    for path in paths:
+        if not os.path.exists(path):
+            _fail(f'missing chunk {path} of {manifest_path}')
+    chunk_list: List[Tuple[Optional[str], int]] = list(manifest['chunk_list'])
+    if not chunk_list and manifest['chunker'] == 'fixed':
+        # an older manifest, chunks are as large as they are on disk and only the
+        # whole file's oid and size can be checked
+        chunk_list = [(None, os.path.getsize(path)) for path in paths]
+    offsets = []
+    offset = 0
+    for _, size in chunk_list:
+        offsets.append(offset)
+        offset += size
+    if offset != manifest['size']:
+        _fail(f'chunks of {manifest_path} add up to {offset} bytes, expected {manifest["size"]}')
+
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    tmp_path = f'{dest}.restore'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        _preallocate(fd, manifest['size'])
+        entries = list(zip(paths, offsets, chunk_list))
+        if workers > 1 and len(entries) > 1:
+            with ThreadPoolExecutor(max_workers=workers + 1, thread_name_prefix='restore') as pool:
+                hashed = pool.submit(_hash_chunks, paths, chunk_list, buffer_size)
+                for future in [pool.submit(_restore_chunk, fd, path, offset, entry, buffer_size) for path, offset, entry in entries]:
+                    future.result()
+                oid, size = hashed.result()
+        else:
+            hash = hashlib.sha256()
+            size = sum(_restore_chunk(fd, path, offset, entry, buffer_size, hash) for path, offset, entry in entries)
+            oid = f'sha256:{hash.hexdigest()}'
+
+        if size != manifest['size']:
+            _fail(f'{dest} restored {size} bytes, expected {manifest["size"]}')
+        if oid != manifest['oid']:
+            _fail(f'{dest} restored as {oid}, expected {manifest["oid"]}')
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+    os.close(fd)
+    os.replace(tmp_path, dest)
+
+    log.info(f'restore_file() path={dest} chunks={manifest["chunks"]} size={manifest["size"]}')
+    return manifest
+
+def _root(path: str) -> str:
+    """
+    Directory that files restored from `path` keep their path relative to
+    """
+    path = path.rstrip('/')
+    if os.path.isfile(path):
+        # a manifest, relative to the `.d` directory's parent
+        return os.path.dirname(os.path.dirname(path))
+    if path.endswith('.d'):
+        return os.path.dirname(path)
+    return path
+
+def find_manifests(path: str) -> List[str]:
+    """
+    Manifests of every chunked file at or below `path`
+    """
+    if os.path.isfile(path):
+        return [path]
+    if path.rstrip('/').endswith('.d') and os.path.isfile(os.path.join(path, MANIFEST_NAME)):
+        return [os.path.join(path, MANIFEST_NAME)]
+    return sorted(
+        # the chunk store only holds chunks, no need to list them
+        file_path for file_path, _ in walk(path, skip=('.git', CHUNK_STORE_DIR))
+        if os.path.basename(file_path) == MANIFEST_NAME and os.path.dirname(file_path).endswith('.d')
+    )
+
+def restore(paths: List[str], out: Optional[str] = None, workers: int = 1, jobs: int = 1, force: bool = False) -> List[str]:
+    """
+    Restore every chunked file found in `paths`, `jobs` files at a time, returns the
+    manifests that failed
+    """
+    targets: List[Tuple[str, Optional[str]]] = []
+    for path in paths:
+        root = _root(path)
+        for manifest_path in find_manifests(path):
+            dest = None
+            if out is not None:
+                # the restored file's path relative to `root`, below `out`
+                chunk_dir = os.path.dirname(manifest_path)
+                rel = os.path.relpath(chunk_dir[:-len('.d')], root)
+                dest = os.path.join(out, rel)
+            targets.append((manifest_path, dest))
+    log.info(f'restore() restoring {len(targets)} files')
+
+    failed: List[str] = []
+    def _restore(target: Tuple[str, Optional[str]]):
+        try:
+            restore_file(target[0], target[1], workers, force=force)
+        except Exception as e:
+            # already logged for mismatches, not for eg. a full disk
+            if not isinstance(e, RuntimeError):
+                log.error(f'ERROR: restore() failed to restore {target[0]}: {e}')
+            failed.append(target[0])
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1), thread_name_prefix='file') as pool:
+        list(pool.map(_restore, targets))
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Reassemble chunked files from their manifests')
+    parser.add_argument('paths', nargs='+', metavar='PATH', help='manifest, `<file>.d` directory or directory to search')
+    parser.add_argument('--out', default=None, help='restore below this directory instead of next to the chunks')
+    parser.add_argument('--workers', type=int, default=min(os.cpu_count() or 1, 8), help='threads writing the chunks of a file')
+    parser.add_argument('--jobs', type=int, default=1, help='files restored at a time')
+    parser.add_argument('--force', action='store_true', help='overwrite files that already exist')
+    args = parser.parse_args()
+
+    failed = restore(args.paths, args.out, args.workers, args.jobs, args.force)
+    if failed:
+        log.error(f'ERROR: main() failed to restore {len(failed)} files')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from git_backup import metrics
+from git_backup.cron import Cron
+from git_backup.logger import get_logger
+from git_backup.sync import get_host_limits, get_repo_host, get_repo_path, get_sync_config, run_repo, write_metrics
+from git_backup.types import Config, PathConfig, RepoConfig
+
+log = get_logger('scheduler')
+
+# first retry of a failed job, doubled on every failure in a row like `main.backoff()`
+RETRY_DELAY = 200
+
+class Job:
+    """
+    Paths of a repo that share a schedule, synced on that schedule
+    """
+    def __init__(self, repo: RepoConfig, paths: List[PathConfig], schedule: Optional[Cron], interval: float, jitter: float) -> None:
+        self.repo = repo
+        self.paths = paths
+        self.schedule = schedule
+        self.interval = interval # minutes, when there's no schedule
+        self.jitter = jitter # minutes
+        self.key = get_repo_path(repo) # jobs of the same repo never run at the same time
+        # what makes it the same job in a reloaded config
+        self.ident = (self.key, tuple((path['local'], path['remote']) for path in paths), str(schedule or ''), interval)
+        self.failures = 0
+
+    @property
+    def name(self) -> str:
+        name = f'{self.repo["owner"]}/{self.repo["name"]}'
+        if len(self.paths) == len(self.repo['paths']):
+            return name
+        return f'{name}:{",".join(path["remote"] for path in self.paths)}'
+
+    def _jitter(self) -> float:
+        return random.uniform(0, self.jitter * 60) if self.jitter > 0 else 0
+
+    def first_due(self, now: float) -> float:
+        if self.schedule is not None:
+            return now + self.schedule.next() + self._jitter()
+        # interval jobs start right away, spread over the jitter window
+        return now + self._jitter()
+
+    def next_due(self, started: float, now: float, ok: bool) -> float:
+        if self.schedule is not None:
+            due = now + self.schedule.next()
+        else:
+            # measured from the start, so a long sync doesn't push every later one back,
+            # one that overran its interval runs again right away instead of catching up
+            due = max(started + self.interval * 60, now)
+        due += self._jitter()
+
+        if ok:
+            self.failures = 0
+            return due
+        self.failures += 1
+        metrics.inc('git_backup_retries_total')
+        return min(due, now + RETRY_DELAY * 2 ** (self.failures - 1))
+
+def _schedule_of(conf: dict) -> Optional[Tuple[Optional[Cron], float]]:
+    """
+    (schedule, interval) of a repo or path, None if it doesn't set its own
+    """
+    if conf.get('schedule') is not None:
+        # the interval only matters without a schedule
+        return conf['schedule'], 0
+    if conf.get('interval') is not None:
+        return None, float(conf['interval'])
+    return None
+
+def make_jobs(conf: Config) -> List[Job]:
+    """
+    One job per repo, plus one per path with its own `schedule` or `interval`
+    """
+    loop = conf['loop']
+    # `validate_conf()` makes sure there's an interval when there's no schedule
+    default = (loop.get('schedule'), float(loop.get('interval') or 0))
+    jitter = float(loop.get('jitter') or 0)
+
+    jobs = []
+    for repo in conf['repos']:
+        repo_schedule = _schedule_of(repo) or default
+        shared: List[PathConfig] = []
+        for path in repo['paths']:
+            path_schedule = _schedule_of(path)
+            if path_schedule is None:
+                shared.append(path)
+            else:
+                jobs.append(Job(repo, [path], *path_schedule, jitter))
+        if shared:
+            jobs.append(Job(repo, shared, *repo_schedule, jitter))
+    return jobs
+
+class Scheduler:
+    """
+    Runs every job whenever it is due, from a priority queue of next due times
+
+    At most `sync.workers` jobs run at once (and `sync.per_host` per endpoint host).
+    A job due while another job of the same repo runs waits for it to finish.
+    With `reload` and `loop.watch`, a changed config is picked up between syncs.
+    """
+    def __init__(self, conf: Config, reload: Optional[Callable[[], Optional[Config]]] = None) -> None:
+        self.conf = conf
+        self.reload = reload
+        self.jobs: Dict[tuple, Job] = {job.ident: job for job in make_jobs(conf)}
+        self.host_limits = get_host_limits(conf)
+        self.cond = threading.Condition()
+        # (due, seq, job), seq keeps jobs due at the same time in order. entries of
+        # jobs a reload replaced are dropped as they come up
+        self.heap: List[Tuple[float, int, Job]] = []
+        self.seq = 0
+        # repos with a job running, and (due, job) of jobs that came due meanwhile
+        self.busy: Dict[str, Job] = {}
+        self.waiting: Dict[str, List[Tuple[float, Job]]] = {}
+        self.workers = get_sync_config(conf)['workers']
+        self.pool: Optional[ThreadPoolExecutor] = None
+        self.stopped = False
+
+    def _push(self, job: Job, due: float):
+        self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, job))
+
+    def _current(self, job: Job) -> Optional[Job]:
+        # the job's counterpart in the current config, None if it was removed
+        return self.jobs.get(job.ident)
+
+    def _run(self, job: Job):
+        started = time.time()
+        conf = self.conf
+        ok = run_repo(job.repo, conf, self.host_limits.get(get_repo_host(job.repo)), job.paths)
+        write_metrics(conf)
+
+        with self.cond:
+            now = time.time()
+            due = job.next_due(started, now, ok)
+            del self.busy[job.key]
+            # let a job of the same repo that came due meanwhile go next, queued at the
+            # time it came due and ahead of this one, which may well be due again already
+            for waiting_due, waiting in self.waiting.pop(job.key, []):
+                current = self._current(waiting)
+                if current is not None:
+                    self._push(current, waiting_due)
+            current = self._current(job)
+            if current is None:
+                log.info(f'_run() {job.name} is no longer configured, not rescheduling it')
+            else:
+                current.failures = job.failures
+                log.info(f'_run() {job.name} next sync in {round(due - now)} seconds')
+                self._push(current, due)
+            self.cond.notify()
+
+    def update(self, conf: Config):
+        """
+        Switch to a reloaded `conf`, called with `cond` held
+
+        Jobs that are still configured the same way keep their due time and failures,
+        new ones are scheduled as on startup. Running syncs finish with the old config.
+        The worker pool, and with it module level caches, stays unless `sync.workers`
+        changed.
+        """
+        due_of = {job.ident: due for due, _, job in self.heap if self._current(job) is job}
+        # rescheduled once the running job of their repo finishes
+        pending = {job.ident for job in self.busy.values()}
+        pending.update(job.ident for jobs in self.waiting.values() for _, job in jobs)
+
+        old_conf = self.conf
+        old_jobs = self.jobs
+        self.conf = conf
+        self.jobs = {job.ident: job for job in make_jobs(conf)}
+        now = time.time()
+        for ident, job in self.jobs.items():
+            if ident in old_jobs:
+                job.failures = old_jobs[ident].failures
+            if ident not in pending:
+                self._push(job, due_of[ident] if ident in due_of else job.first_due(now))
+
+        host_limits = get_host_limits(conf)
+        if get_sync_config(conf)['per_host'] == get_sync_config(old_conf)['per_host']:
+            # keep the semaphores running syncs hold
+            host_limits.update({host: self.host_limits[host] for host in host_limits if host in self.host_limits})
+        self.host_limits = host_limits
+
+        workers = get_sync_config(conf)['workers']
+        if workers != self.workers and self.pool is not None:
+            # running syncs finish on the old pool
+            self.pool.shutdown(wait=False)
+            self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sync')
+        self.workers = workers
+        log.info(f'update() scheduling {len(self.jobs)} jobs with {workers} workers')
+        self.cond.notify()
+
+    def _watch(self) -> float:
+        if self.reload is None:
+            return 0
+        return float(self.conf['loop'].get('watch') or 0)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def run(self):
+        log.info(f'run() scheduling {len(self.jobs)} jobs with {self.workers} workers')
+        with self.cond:
+            now = time.time()
+            for job in self.jobs.values():
+                self._push(job, job.first_due(now))
+
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sync')
+        try:
+            with self.cond:
+                next_poll = time.time() + self._watch()
+                while not self.stopped:
+                    now = time.time()
+                    if self._watch() > 0 and now >= next_poll:
+                        conf = self.reload()
+                        if conf is not None:
+                            self.update(conf)
+                        next_poll = now + self._watch()
+                    # woken early when a job finishes and queues another
+                    timeout = next_poll - now if self._watch() > 0 else None
+
+                    if not self.heap:
+                        self.cond.wait(timeout)
+                        continue
+                    due, _, job = self.heap[0]
+                    if self._current(job) is not job:
+                        # replaced or removed by a reload
+                        heapq.heappop(self.heap)
+                        continue
+                    wait = due - now
+                    if wait > 0:
+                        self.cond.wait(wait if timeout is None else min(wait, timeout))
+                        continue
+
+                    heapq.heappop(self.heap)
+                    if job.key in self.busy:
+                        log.info(f'run() {job.name} due while {self.busy[job.key].name} is running, waiting for it')
+                        self.waiting.setdefault(job.key, []).append((due, job))
+                        continue
+                    self.busy[job.key] = job
+                    self.pool.submit(self._run, job)
+        finally:
+            self.pool.shutdown()
@@ -1,30 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from itertools import groupby
 from genericpath import isfile
-import hashlib
-from typing import List, Optional
-import subprocess
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+import logging
 import os
 import shutil
 import pathlib
+import re
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
 
-from git_backup.config import DEFAULT_COMMIT_MESSAGE
+from git_backup.config import DEFAULT_ARCHIVE_DETERMINISTIC, DEFAULT_ARCHIVE_STREAM, DEFAULT_ARCHIVE_THREADS, DEFAULT_CHUNK_AVG_SIZE, DEFAULT_CHUNK_BUFFER_SIZE, DEFAULT_CHUNK_WORKERS, DEFAULT_CHUNKING_MODE, DEFAULT_COMMIT_MESSAGE, DEFAULT_ENDPOINT, DEFAULT_METRICS_PORT, DEFAULT_SYNC_BRANCH_WORKERS, DEFAULT_SYNC_INDEX, DEFAULT_SYNC_PER_HOST, DEFAULT_SYNC_PIPELINE, DEFAULT_SYNC_TIMEOUT, DEFAULT_SYNC_WORKERS, DEFAULT_SYNC_WORKTREES
+from git_backup import archive, chunking, fastcopy, index, metrics, pipeline, proc
 from git_backup.secrets import Secrets
-from git_backup.logger import get_logger
-from git_backup.types import Config, OversizeHandler, OversizeHandlerType, PathConfig, RSyncConfig, RepoConfig
+from git_backup.logger import get_logger, log_context
+from git_backup.walk import walk, walk_paths
+from git_backup.types import ArchiveConfig, ChangeSet, ChunkingConfig, CompressType, Config, Manifest, MetricsConfig, OversizeHandler, OversizeHandlerType, PathConfig, PathWork, RSyncConfig, RepoConfig, Snapshot, SyncConfig
 
 log = get_logger('sync')
 
-def exec_sh(cmd: List[str], cwd: Optional[str] = None) -> str:
-    proc = subprocess.Popen(cmd, 
-                            cwd=cwd,
-                            stdout=subprocess.PIPE, 
-                            stderr=subprocess.PIPE, 
-                            universal_newlines=True)
-    stdout, stderr = proc.communicate()
-    if proc.returncode != 0:
-        log.error(f'ERROR: exec_sh() Failed to execute command: {" ".join(cmd)}. \nError: {stderr}')
-        raise RuntimeError(f'Failed to execute command: {" ".join(cmd)}. \nError: {stderr}')
-        
-    return stdout
+def exec_sh(cmd: List[str], cwd: Optional[str] = None, input: Optional[str] = None, log_error: bool = True, binary: bool = False, timeout: Optional[float] = None, env: Optional[Dict[str, str]] = None) -> Union[str, bytes]:
+    return proc.run_sync(cmd, cwd=cwd, input=input, binary=binary, timeout=timeout, log_error=log_error, env=env)
 
 def mkdir_p(path: str):
     pathlib.Path(path).mkdir(parents=True, exist_ok=True)
@@ -46,9 +45,95 @@ def get_repo_url(repo: RepoConfig, token: Optional[str] = None) -> str:
         protocol, url = 'https', spl[0]
     return f'{protocol}://{token}@{url}'
 
+# answers git's credential requests from the environment, so with `git.credential_helper`
+# the token never appears in a command line, remote URL or `.git/config`
+CREDENTIAL_HELPER = '!f() { test "$1" = get && echo username=x-access-token && echo "password=$GIT_BACKUP_TOKEN"; }; f'
+
+# fewer round trips per command, and multiplexed requests over one HTTP/2 connection
+TRANSPORT_CONFIG = ('protocol.version=2', 'http.version=HTTP/2')
+
+# shared ssh connection per endpoint, reused by every git command for a while after the last one
+SSH_COMMAND = 'ssh -o ControlMaster=auto -o ControlPath=/tmp/git-backup-ssh-%C -o ControlPersist=120'
+
+# with `git.many_files`, a smaller index and cached untracked directory listings, keys as
+# `git config --get-regexp` prints them
+MANY_FILES_CONFIG = {"feature.manyFiles": 'true', "core.untrackedCache": 'true'}
+MANY_FILES_PATTERN = '^(feature\\.manyfiles|core\\.untrackedcache)$'
+
+# (url, git options, environment) for commands talking to a repo's remote
+GitRemote = Tuple[str, List[str], Dict[str, str]]
+
+def get_git_remote(repo: RepoConfig, secrets: Secrets) -> GitRemote:
+    """
+    Remote URL plus the `-c` options and environment git needs to reach it
+    
+    By default the token is part of the URL. With `git.credential_helper` it is
+    handed to git through the environment instead, and connection reuse is tuned.
+    """
+    token = secrets.get_token(repo['owner'], repo['name'])
+    # never wait for a password on a terminal nobody is watching
+    env = {"GIT_TERMINAL_PROMPT": '0'}
+    if not repo['git'].get('credential_helper'):
+        return get_repo_url(repo, token), [], env
+    
+    options = [*TRANSPORT_CONFIG, 'credential.helper=', f'credential.helper={CREDENTIAL_HELPER}']
+    if get_repo_url(repo).startswith('ssh://'):
+        options.append(f'core.sshCommand={SSH_COMMAND}')
+    if token is not None:
+        env['GIT_BACKUP_TOKEN'] = token
+    
+    args = []
+    for option in options:
+        args.extend(["-c", option])
+    return get_repo_url(repo), args, env
+
+# branches fetched from the remote during the current cycle, by repo path
+_fetched: Dict[str, Set[str]] = {}
+
+def get_repo_branches(repo: RepoConfig) -> List[str]:
+    """
+    Every branch the repo's paths sync to, default branch first
+    """
+    branches = [repo['branch']]
+    for path in repo['paths']:
+        branch = path.get('branch')
+        if branch and branch not in branches:
+            branches.append(branch)
+    return branches
+
+def _fetch_refspecs(branches: List[str]) -> List[str]:
+    return [f'+refs/heads/{branch}:refs/remotes/origin/{branch}' for branch in branches]
+
+def _git_fetch_branches(repo: RepoConfig, remote: GitRemote, branches: List[str], shallow: bool) -> List[str]:
+    """
+    Fetch `branches` in one call, returns those that exist on the remote
+    """
+    local_path = get_repo_path(repo)
+    url, args, env = remote
+    branches = list(branches)
+    while branches:
+        cmd = ["git", *args, "fetch", '-q', '--no-tags']
+        if shallow:
+            cmd.extend(["--depth", "1"])
+        try:
+            exec_sh(cmd + [url] + _fetch_refspecs(branches), cwd=local_path, log_error=False, env=env)
+            return branches
+        except RuntimeError as e:
+            # a branch that doesn't exist on the remote yet fails the whole fetch, drop it and retry
+            missing = re.search(r"couldn't find remote ref refs/heads/(\S+)", str(e))
+            if not missing or missing.group(1) not in branches:
+                log.error(f'ERROR: git_fetch() {e}')
+                raise
+            log.info(f'git_fetch() branch not on remote yet: {missing.group(1)}')
+            branches.remove(missing.group(1))
+    return branches
+
 def git_fetch(repo: RepoConfig, secrets: Secrets):
     """
-    Fetch the ref from remote
+    Fetch every branch the repo's paths need in a single round trip, then switch to the default branch
+    
+    Branches seen before are fetched incrementally, new ones shallow. Later `git_checkout()`s
+    in the same cycle only switch locally.
     """
     local_path = get_repo_path(repo)
     git_path = f'{local_path}/.git'
@@ -58,19 +143,153 @@ def git_fetch(repo: RepoConfig, secrets: Secrets):
         log.error(f'ERROR: git_fetch() Invalid path. Expecting .git directory at path: {git_path}')
         raise RuntimeError(f'Invalid path. Expecting .git directory at path: {git_path}')
     
-    url = get_repo_url(repo, secrets.get_token(repo['owner'], repo['name']))
+    remote = get_git_remote(repo, secrets)
+    url, args, env = remote
     branch = repo['branch']
+    branches = get_repo_branches(repo)
+    fetched: Set[str] = set()
 
     if not exists:
         # first pull
         log.info('git_fetch() first pull')
-        exec_sh(["git", "clone", url, '-q', "--depth", "1", "--branch", branch, "."], cwd=local_path)
+        cmd = ["git", *args, "clone", url, '-q', "--depth", "1", "--branch", branch]
+        clone_filter = repo['git'].get('clone_filter')
+        if clone_filter:
+            # blobs are fetched on demand, only for what gets checked out
+            cmd.append(f'--filter={clone_filter}')
+        if get_sparse_dirs(repo) is not None:
+            # top level files only until `git_sparse_checkout()` widens it
+            cmd.append('--sparse')
+        exec_sh(cmd + ["."], cwd=local_path, env=env)
+        fetched.add(branch)
+        known = []
+        new = branches[1:]
     else:
         # subsequent pulls
-        log.info('git_fetch() subsequent pull')
-        exec_sh(["git", "fetch", '-q', url], cwd=local_path)
-        exec_sh(["git", "switch", '-q', branch], cwd=local_path)
-        exec_sh(["git", "pull", '-q', url, branch], cwd=local_path)
+        log.info(f'git_fetch() subsequent pull branches={",".join(branches)}')
+        refs = exec_sh(["git", "for-each-ref", "--format=%(refname)", "refs/remotes/origin/"], cwd=local_path).split()
+        known = [b for b in branches if f'refs/remotes/origin/{b}' in refs]
+        new = [b for b in branches if b not in known]
+        
+        if repo['git'].get('credential_helper') and exec_sh(["git", "remote", "get-url", "origin"], cwd=local_path).strip() != url:
+            # drop a token the clone stored in the remote URL
+            log.info('git_fetch() removing credentials from remote url')
+            exec_sh(["git", "remote", "set-url", "origin", url], cwd=local_path)
+    
+    if new:
+        # `--depth` clones only map their one branch, switching to the others needs the full mapping
+        exec_sh(["git", "config", "--replace-all", "remote.origin.fetch", "+refs/heads/*:refs/remotes/origin/*"], cwd=local_path)
+    
+    if known:
+        fetched.update(_git_fetch_branches(repo, remote, known, shallow=False))
+    if new:
+        fetched.update(_git_fetch_branches(repo, remote, new, shallow=True))
+    
+    _fetched[local_path] = fetched
+    git_sparse_checkout(repo)
+    git_many_files(repo)
+    _git_switch(repo, branch)
+
+def get_sparse_dirs(repo: RepoConfig) -> Optional[List[str]]:
+    """
+    Directories the repo's paths sync into, relative to the repo root, or None when
+    `git.sparse` is off or a path syncs into the root itself
+    """
+    if not repo['git'].get('sparse'):
+        return None
+    
+    repo_path = get_repo_path(repo)
+    dirs = []
+    for path in repo['paths']:
+        dest = get_sync_dest(repo, path)
+        if path['compress'] or os.path.isfile(path['local']):
+            dest = os.path.dirname(dest)
+        rel = os.path.relpath(dest, repo_path)
+        if rel == '.' or rel.startswith('..'):
+            return None
+        dirs.append(rel.replace(os.sep, '/'))
+    if repo['oversize_handler'] == 'chunking' and get_chunking_config(repo)['mode'] == 'cdc':
+        dirs.append(chunking.CHUNK_STORE_DIR)
+    return sorted(set(dirs))
+
+def git_sparse_checkout(repo: RepoConfig):
+    """
+    Limit the work tree to the directories the repo's paths sync into
+    
+    Uses cone mode, so top level files like `.gitattributes` stay checked out.
+    Only rewrites the patterns when the paths changed.
+    """
+    dirs = get_sparse_dirs(repo)
+    if dirs is None:
+        return
+    
+    local_path = get_repo_path(repo)
+    try:
+        current = exec_sh(["git", "sparse-checkout", "list"], cwd=local_path, log_error=False).splitlines()
+    except RuntimeError:
+        # not sparse yet
+        current = None
+    if current == dirs:
+        return
+    
+    log.info(f'git_sparse_checkout() dirs={",".join(dirs)}')
+    exec_sh(["git", "sparse-checkout", "set", "--cone", *dirs], cwd=local_path)
+
+def git_many_files(repo: RepoConfig):
+    """
+    Tune the repo's index for a large work tree when `git.many_files` is on
+    
+    A version 4 index and the untracked cache let `git add` and `git status` skip
+    directories that didn't change. Only writes settings that aren't set yet.
+    """
+    if not repo['git'].get('many_files'):
+        return
+    
+    local_path = get_repo_path(repo)
+    try:
+        current = exec_sh(["git", "config", "--local", "--get-regexp", MANY_FILES_PATTERN], cwd=local_path, log_error=False)
+    except RuntimeError:
+        # none of them set
+        current = ''
+    current = dict(line.split(' ', 1) for line in current.splitlines())
+    for key, value in MANY_FILES_CONFIG.items():
+        if current.get(key.lower()) != value:
+            log.info(f'git_many_files() setting {key}={value}')
+            exec_sh(["git", "config", "--local", key, value], cwd=local_path)
+
+def _branch_start(repo: RepoConfig, branch: str, fetched: Set[str]) -> str:
+    """
+    Where a branch missing locally starts: the remote's, or the remote default branch,
+    so it doesn't depend on what was committed locally this cycle
+    """
+    start = branch if branch in fetched else repo['branch']
+    return f'refs/remotes/origin/{start}' if start in fetched else start
+
+def _git_merge(branch: str, cwd: str):
+    # only fast forwards, a branch that diverged from the remote fails rather than
+    # quietly getting a merge commit
+    exec_sh(["git", "merge", '-q', '--ff-only', f'refs/remotes/origin/{branch}'], cwd=cwd)
+
+def _git_switch(repo: RepoConfig, branch: str):
+    """
+    Switch to `branch` and bring it up to date with what was fetched this cycle, no network
+    """
+    local_path = get_repo_path(repo)
+    fetched = _fetched.get(local_path, set())
+    
+    try:
+        # creates a tracking branch from refs/remotes/origin/<branch> if needed
+        exec_sh(["git", "switch", '-q', branch], cwd=local_path, log_error=branch in fetched)
+    except RuntimeError:
+        if branch in fetched:
+            raise
+        # not on the remote yet, start it from the default branch
+        log.info(f'git_checkout() creating branch={branch}')
+        exec_sh(["git", "switch", '-q', '-c', branch, _branch_start(repo, branch, fetched)], cwd=local_path)
+        return
+    
+    if branch in fetched:
+        _git_merge(branch, local_path)
         
 def git_checkout(repo: RepoConfig, branch: str, secrets: Secrets):
     """
@@ -80,19 +299,89 @@ def git_checkout(repo: RepoConfig, branch: str, secrets: Secrets):
     log.info(f'git_checkout() owner={owner} repo={name} branch={branch}')
     
     local_path = get_repo_path(repo)
-    url = get_repo_url(repo, secrets.get_token(owner, name))
+    if local_path not in _fetched:
+        # not planned by `git_fetch()` this cycle
+        _fetched[local_path] = set(_git_fetch_branches(repo, get_git_remote(repo, secrets), [branch], shallow=False))
+    
+    _git_switch(repo, branch)
+    
+def get_worktree_path(repo: RepoConfig, branch: str) -> str:
+    """
+    Work tree of `branch`, the default branch uses the repo's own
+    """
+    if branch == repo['branch']:
+        return get_repo_path(repo)
+    return os.path.join(get_state_path(repo), 'worktrees', branch)
+
+def git_worktree(repo: RepoConfig, branch: str) -> RepoConfig:
+    """
+    Make sure `branch` has its own work tree, up to date with this cycle's fetch, and
+    return a copy of `repo` rooted at it
+    
+    Work trees persist between cycles so rsync always compares against the branch's
+    own files. They share the repo's objects, refs and `.git/info/exclude`.
+    """
+    worktree_path = get_worktree_path(repo, branch)
+    if worktree_path == get_repo_path(repo):
+        return repo
+    
+    local_path = get_repo_path(repo)
+    fetched = _fetched.get(local_path, set())
+    branch_repo: RepoConfig = {**repo, "storage_root": worktree_path}
+    
+    if not os.path.exists(os.path.join(worktree_path, '.git')):
+        log.info(f'git_worktree() adding branch={branch} path={worktree_path}')
+        # forget work trees whose directory went missing, they'd keep the branch checked out
+        exec_sh(["git", "worktree", "prune"], cwd=local_path)
+        mkdir_p(os.path.dirname(worktree_path))
+        
+        sparse = get_sparse_dirs(repo) is not None
+        # a sparse work tree is populated once its own patterns are set
+        cmd = ["git", "worktree", "add", '-q'] + (['--no-checkout'] if sparse else [])
+        if has_local_branch(repo, branch):
+            exec_sh(cmd + [worktree_path, branch], cwd=local_path)
+        else:
+            exec_sh(cmd + ['-b', branch, worktree_path, _branch_start(repo, branch, fetched)], cwd=local_path)
+        
+        if sparse:
+            git_sparse_checkout(branch_repo)
+            exec_sh(["git", "reset", '-q', '--hard'], cwd=worktree_path)
+    else:
+        git_sparse_checkout(branch_repo)
     
-    exec_sh(["git", "fetch", '-q', url], cwd=local_path)
-    exec_sh(["git", "switch", '-q', branch], cwd=local_path)
-    exec_sh(["git", "pull", '-q', url, branch], cwd=local_path)
+    if branch in fetched:
+        _git_merge(branch, worktree_path)
+    return branch_repo
+
+def has_local_branch(repo: RepoConfig, branch: str) -> bool:
+    try:
+        exec_sh(["git", "rev-parse", '-q', '--verify', f'refs/heads/{branch}'], cwd=get_repo_path(repo), log_error=False)
+        return True
+    except RuntimeError:
+        return False
     
-def git_add(repo: RepoConfig, path: str):
-    if repo['git']['add'] == False:
+def _pathspec(cmd: List[str], paths: List[str]) -> Tuple[List[str], Optional[str]]:
+    """
+    Pass a single path as an argument, many as NUL separated stdin so the command line 
+    never outgrows ARG_MAX
+    """
+    # file names, not patterns
+    cmd = [cmd[0], "--literal-pathspecs", *cmd[1:]]
+    if len(paths) == 1:
+        return cmd + ["--", paths[0]], None
+    return cmd + ["--pathspec-from-file=-", "--pathspec-file-nul"], '\0'.join(paths)
+
+def _describe(paths: List[str]) -> str:
+    return paths[0] if len(paths) == 1 else f'<{len(paths)} paths>'
+
+def git_add(repo: RepoConfig, *paths: str):
+    if repo['git']['add'] == False or not paths:
         return
     
     local_path = get_repo_path(repo)
-    log.info(f'git_add() path={path}')
-    exec_sh(["git", "add", path], cwd=local_path)
+    log.info(f'git_add() path={_describe(paths)}')
+    cmd, stdin = _pathspec(["git", "add"], list(paths))
+    exec_sh(cmd, cwd=local_path, input=stdin)
     
 
 def resolve_remote(repo: RepoConfig, path: str) -> str:
@@ -112,61 +401,299 @@ def git_status(repo: RepoConfig, porcelain: bool = False) -> str:
         cmd.append('--porcelain')
     return exec_sh(cmd, cwd=local_path)
 
+def git_staged(repo: RepoConfig) -> str:
+    """
+    Changes staged for the next commit, one `<status>\t<path>` per line, empty if none
+    """
+    local_path = get_repo_path(repo)
+    return exec_sh(["git", "diff", "--cached", "--name-status", "--no-renames"], cwd=local_path)
+
 def git_commit(repo: RepoConfig) -> str:
     if repo['git']['commit'] == False:
         return
     
     local_path = get_repo_path(repo)
     
+    # per invocation rather than `git config`, work trees share the repo's config file
+    cmd = ["git"]
     if 'email' in repo['git']:
-        email = repo['git']['email']
-        exec_sh(["git", "config", "user.email", email], cwd=local_path)
+        cmd.extend(["-c", f'user.email={repo["git"]["email"]}'])
         
     if 'name' in repo['git']:
-        name = repo['git']['name']
-        exec_sh(["git", "config", "user.name", name], cwd=local_path)
+        cmd.extend(["-c", f'user.name={repo["git"]["name"]}'])
     
     message = repo['git']['message'] if 'message' in repo['git'] else DEFAULT_COMMIT_MESSAGE
     
     log.info('git_commit()')
-    return exec_sh(["git", "commit", "-m", message], cwd=local_path)
+    return exec_sh(cmd + ["commit", "-m", message], cwd=local_path)
 
-def git_push(repo: RepoConfig) -> str:
+def git_push(repo: RepoConfig, branches: Optional[List[str]] = None, secrets: Optional[Secrets] = None) -> str:
+    """
+    Push the current branch, or every branch in `branches` with one push
+    """
     if repo['git']['push'] == False:
         return
     
     local_path = get_repo_path(repo)
+    # the remote URL is the one `git_fetch()` cloned or set
+    _, args, env = get_git_remote(repo, secrets or Secrets({}))
     
-    cmd = ["git", "push"]
+    cmd = ["git", *args, "push"]
     if 'force_push' in repo['git'] and repo['git']['force_push'] == True:
         cmd.append('-f')
+    if branches:
+        cmd.append('origin')
+        cmd.extend(f'refs/heads/{b}:refs/heads/{b}' for b in branches)
         
-    log.info(f'git_push() cmd={" ".join(cmd)}')
-    return exec_sh(cmd, cwd=local_path)
+    log.info(f'git_push() cmd=git push {" ".join(cmd[len(args) + 2:])}')
+    out = exec_sh(cmd, cwd=local_path, env=env)
+    
+    push_path = get_push_path(repo)
+    mkdir_p(os.path.dirname(push_path))
+    open(push_path, 'w').close()
+    return out
 
-def check_sizes(repo: RepoConfig, ppath: str, oversize_handler: OversizeHandler) -> List[str]:
-    """Traverse each child, if size exceeds limit call oversize handler
+def get_unpushed_branches(repo: RepoConfig) -> List[str]:
+    """
+    Branches of the repo with local commits the remote doesn't have, as of the last
+    fetch or push, without going to the network
+    """
+    refs: Dict[str, str] = {}
+    out = exec_sh(["git", "for-each-ref", "--format=%(objectname) %(refname)", "refs/heads/", "refs/remotes/origin/"], cwd=get_repo_path(repo))
+    for line in out.splitlines():
+        oid, _, ref = line.partition(' ')
+        refs[ref] = oid
+    
+    unpushed = []
+    for branch in get_repo_branches(repo):
+        local = refs.get(f'refs/heads/{branch}')
+        if local is not None and local != refs.get(f'refs/remotes/origin/{branch}'):
+            unpushed.append(branch)
+    return unpushed
+
+def get_push_path(repo: RepoConfig) -> str:
+    # touched after every push, its mtime is the time of the last one
+    return os.path.join(get_state_path(repo), 'pushed')
+
+def push_due(repo: RepoConfig) -> bool:
+    """
+    Whether `git.push_window` seconds have passed since the repo was last pushed
+    """
+    window = repo['git'].get('push_window') or 0
+    if window <= 0:
+        return True
+    try:
+        return time.time() - os.stat(get_push_path(repo)).st_mtime >= window
+    except FileNotFoundError:
+        return True
+
+def check_sizes(repo: RepoConfig, ppath: str, oversize_handler: OversizeHandler, changed: Optional[Iterable[str]] = None) -> List[str]:
+    """Walk `ppath`, or only the `changed` files when known, and call the oversize 
+    handler for each file over the size limit
     """
     
     max_file_size = repo['max_file_size']
     uncache_paths = []
     repo_path = get_repo_path(repo)
     
-    def _check_sizes(path: str):
-        if os.path.isfile(path):
-            file_stat = os.stat(path)
-            if file_stat.st_size > max_file_size:
-                log.info(f'check_size() file over max size. path={path} size={file_stat.st_size}')
-                if oversize_handler(path, file_stat, repo):                    
-                    uncache_paths.append(path)
-        elif os.path.isdir(path):
-            for child in os.scandir(path):
-                _check_sizes(child.path)
-                
-    _check_sizes(os.path.join(repo_path, ppath))
+    if changed is None:
+        files = walk(os.path.join(repo_path, ppath))
+    else:
+        files = walk_paths(changed)
+    
+    for path, file_stat in files:
+        if file_stat.st_size > max_file_size:
+            log.info(f'check_size() file over max size. path={path} size={file_stat.st_size}')
+            if oversize_handler(path, file_stat, repo):
+                uncache_paths.append(path)
     return uncache_paths
     
-def compress(repo: RepoConfig, path: PathConfig) -> str:
+# max bytes of arguments passed to a single command that can't read them from stdin
+ARG_BATCH_SIZE = 64 * 1024
+
+# filter patterns rsync `--delete` must leave alone in the destination, chunk
+# directories are protected one by one, see `get_chunk_dirs()`
+RSYNC_PROTECT = ('.git', '.gitattributes', f'/{chunking.CHUNK_STORE_DIR}/')
+
+# characters of a file name rsync would take for a wildcard
+RSYNC_WILDCARD = re.compile(r'([*?[\\])')
+
+def get_chunk_dirs(repo: RepoConfig, dest: str) -> Set[str]:
+    """
+    Chunk directories of the chunked originals synced into `dest`, relative to it
+    """
+    prefix = os.path.join(dest, '')
+    store = os.path.join(get_repo_path(repo), chunking.CHUNK_STORE_DIR, '')
+    return {
+        os.path.relpath(f'{path}.d', dest).replace(os.sep, '/')
+        for path in get_excluded(repo) if path.startswith(prefix) and not path.startswith(store)
+    }
+
+def is_protected(rel: str, is_dir: bool, chunk_dirs: Set[str] = frozenset()) -> bool:
+    """
+    Whether `RSYNC_PROTECT` or one of `chunk_dirs` covers `rel`, relative to the
+    synced directory
+    """
+    parts = rel.split('/')
+    if any(part in ('.git', '.gitattributes') for part in parts):
+        return True
+    if parts[0] == chunking.CHUNK_STORE_DIR and (is_dir or len(parts) > 1):
+        return True
+    # a chunk directory and everything in it
+    dirs = parts if is_dir else parts[:-1]
+    return any('/'.join(dirs[:i]) in chunk_dirs for i in range(1, len(dirs) + 1))
+
+ARCHIVE_EXTENSIONS = {
+    "zip": ".zip",
+    "tar": ".tar",
+    "gztar": ".tar.gz",
+    "bztar": ".tar.bz2",
+    "xztar": ".tar.xz",
+    "pgztar": ".tar.gz",
+    "zstdtar": ".tar.zst"
+}
+
+def get_archive_path(repo: RepoConfig, path: PathConfig) -> str:
+    """
+    Absolute path of the archive `compress()` writes for `path`
+    """
+    remote_dir = resolve_remote(repo, os.path.dirname(path["remote"]))
+    remote_file = os.path.splitext(os.path.basename(path['remote']))[0]
+    return os.path.join(remote_dir, remote_file) + ARCHIVE_EXTENSIONS[path['compress']]
+
+def get_sync_dest(repo: RepoConfig, path: PathConfig) -> str:
+    """
+    Absolute path in the repo that `path` is synced to
+    """
+    if path['compress']:
+        return get_archive_path(repo, path)
+    return resolve_remote(repo, path["remote"])
+
+def get_git_dir(repo: RepoConfig) -> str:
+    """
+    The repo's `.git` directory, for a linked work tree the main repo's one it shares
+    """
+    git_path = os.path.join(get_repo_path(repo), '.git')
+    if not os.path.isfile(git_path):
+        return git_path
+    
+    # `gitdir: <main>/.git/worktrees/<id>`, which names the shared directory in `commondir`
+    with open(git_path, 'r', encoding='utf8') as stream:
+        worktree_git_dir = stream.read().strip().split('gitdir: ', 1)[-1]
+    try:
+        with open(os.path.join(worktree_git_dir, 'commondir'), 'r', encoding='utf8') as stream:
+            return os.path.normpath(os.path.join(worktree_git_dir, stream.read().strip()))
+    except FileNotFoundError:
+        return worktree_git_dir
+
+def get_state_path(repo: RepoConfig) -> str:
+    """
+    Directory for git-backup's own bookkeeping, kept inside `.git` so it is never committed
+    """
+    return os.path.join(get_git_dir(repo), 'git-backup')
+
+_exclude_lock = threading.Lock()
+
+def git_exclude(repo: RepoConfig, path: str, exclude: bool = True):
+    """
+    Add `path` to, or remove it from, the repo's local excludes (`.git/info/exclude`) 
+    so `git add` of a directory skips it
+    """
+    pattern = '/' + os.path.relpath(path, get_repo_path(repo)).replace(os.sep, '/')
+    exclude_path = os.path.join(get_git_dir(repo), 'info', 'exclude')
+    
+    # shared by every work tree of the repo
+    with _exclude_lock:
+        _git_exclude(exclude_path, pattern, exclude)
+
+def _git_exclude(exclude_path: str, pattern: str, exclude: bool):
+    try:
+        with open(exclude_path, 'r', encoding='utf8') as stream:
+            lines = stream.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+    
+    if (pattern in lines) == exclude:
+        return
+    
+    log.info(f'git_exclude() path={pattern} exclude={exclude}')
+    if exclude:
+        lines.append(pattern)
+    else:
+        lines = [line for line in lines if line != pattern]
+    
+    mkdir_p(os.path.dirname(exclude_path))
+    # replaced whole, git reading it meanwhile sees the old or the new version, never a partial one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(exclude_path), prefix='exclude.', suffix='.tmp')
+    try:
+        # mkstemp() makes it private, git writes it readable by everyone
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'w', encoding='utf8') as stream:
+            stream.write(''.join(f'{line}\n' for line in lines))
+        os.replace(tmp_path, exclude_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def get_excluded(repo: RepoConfig) -> Set[str]:
+    """
+    Absolute paths of the files in the repo's local excludes, ie. chunked originals
+    """
+    repo_path = get_repo_path(repo)
+    exclude_path = os.path.join(get_git_dir(repo), 'info', 'exclude')
+    with _exclude_lock:
+        try:
+            with open(exclude_path, 'r', encoding='utf8') as stream:
+                lines = stream.read().splitlines()
+        except FileNotFoundError:
+            return set()
+    return {os.path.join(repo_path, line[1:]) for line in lines if line.startswith('/')}
+
+def get_archive_config(conf: Config) -> ArchiveConfig:
+    archive_conf = conf.get('archive') or {}
+    return {
+        "deterministic": bool(archive_conf.get('deterministic', DEFAULT_ARCHIVE_DETERMINISTIC)),
+        "level": archive_conf.get('level'),
+        "threads": int(archive_conf.get('threads', DEFAULT_ARCHIVE_THREADS)),
+        "stream": bool(archive_conf.get('stream', DEFAULT_ARCHIVE_STREAM))
+    }
+
+def streams_archive(repo: RepoConfig, config: ArchiveConfig) -> bool:
+    return bool(config.get('stream')) and repo['oversize_handler'] == 'chunking'
+
+def write_archive(repo: RepoConfig, archive_path: str, archive_type: CompressType, entries: list, config: ArchiveConfig) -> str:
+    """
+    Write the archive to `archive_path`, or with `archive.stream` straight into its
+    chunks once it outgrows `max_file_size`
+    """
+    if not streams_archive(repo, config):
+        return archive.make_archive(archive_path, archive_type, entries, config['level'], config['threads'])
+    
+    writer = chunking.ChunkWriter(archive_path, repo['max_file_size'], get_chunking_config(repo), get_repo_path(repo))
+    with writer:
+        archive.write_archive(writer, archive_type, entries, config['level'], config['threads'])
+    if writer.spilled:
+        # like `oh_chunking()`, only the chunks are committed
+        git_exclude(repo, archive_path)
+    return archive_path
+
+def get_index_key(repo: RepoConfig, path: PathConfig, config: ArchiveConfig) -> str:
+    """
+    Key of what's kept about `path` between syncs, settings that change what its sync
+    writes to the repo are part of it, so changing them syncs it afresh
+    """
+    chunking_conf = get_chunking_config(repo)
+    return index.index_key(path, repo['max_file_size'], repo['oversize_handler'], chunking_conf['mode'], chunking_conf['avg_size'], config['level'])
+
+def get_archive_manifest(archive_path: str) -> Optional[Manifest]:
+    """
+    Manifest of an archive that was streamed into chunks, None if it was written whole
+    """
+    if os.path.exists(archive_path):
+        return None
+    return chunking.read_manifest(os.path.join(f'{archive_path}.d', chunking.MANIFEST_NAME))
+
+def compress(repo: RepoConfig, path: PathConfig, config: Optional[ArchiveConfig] = None) -> str:
     archive_type = path['compress']
     if archive_type is None:
         return
@@ -188,15 +715,92 @@ def compress(repo: RepoConfig, path: PathConfig) -> str:
     
     log.info(f'compress() dest={dest} root_dir={root_dir} base_dir={base_dir}') 
     
-    return shutil.make_archive(dest, archive_type, root_dir, base_dir)
+    if config is None:
+        config = {"deterministic": False, "level": None, "threads": DEFAULT_ARCHIVE_THREADS, "stream": DEFAULT_ARCHIVE_STREAM}
+    
+    if not config['deterministic']:
+        if archive_type not in archive.PARALLEL_TYPES and not streams_archive(repo, config):
+            return shutil.make_archive(dest, archive_type, root_dir, base_dir)
+        entries = archive.list_entries(root_dir, base_dir)
+        return write_archive(repo, get_archive_path(repo, path), archive_type, entries, config)
+    
+    # reproducible archive, skipped entirely while the inputs' fingerprint is unchanged
+    archive_path = get_archive_path(repo, path)
+    fingerprint_path = os.path.join(get_state_path(repo), 'archive', get_index_key(repo, path, config))
+    entries = archive.list_entries(root_dir, base_dir)
+    fingerprint = archive.fingerprint(entries)
+    
+    try:
+        with open(fingerprint_path, 'r', encoding='utf8') as stream:
+            prev_fingerprint = stream.read().strip()
+    except IOError:
+        prev_fingerprint = None
+    
+    if prev_fingerprint == fingerprint and (os.path.exists(archive_path) or get_archive_manifest(archive_path) is not None):
+        log.info(f'compress() inputs unchanged, keeping archive={archive_path}')
+        return archive_path
+    
+    write_archive(repo, archive_path, archive_type, entries, config)
+    
+    mkdir_p(os.path.dirname(fingerprint_path))
+    with open(fingerprint_path, 'w', encoding='utf8') as stream:
+        stream.write(fingerprint)
+    return archive_path
+        
+# how rsync escapes control characters in names it outputs, even with `-8`
+RSYNC_ESCAPE = re.compile(rb'\\#([0-7]{3})')
+
+def unescape_name(name: str) -> str:
+    """
+    A name as rsync outputs it, with its `\\#ooo` escapes turned back into bytes
+    """
+    if '\\#' not in name:
+        return name
+    raw = RSYNC_ESCAPE.sub(lambda m: bytes([int(m.group(1), 8)]), name.encode('utf8', 'surrogateescape'))
+    return raw.decode('utf8', 'surrogateescape')
+
+def parse_item(line: str, changes: ChangeSet):
+    """
+    Add a single line of rsync `--out-format='%i %n'` output to `changes`
+    """
+    # 11 character itemized flags (YXcstpoguax), a space, then the name
+    flags, name = line[:11].rstrip(), unescape_name(line[12:])
+    if not name or name.endswith('/'):
+        return
+    if flags == '*deleting':
+        changes['deleted'].append(name)
+    elif len(flags) == 11 and flags[1] in 'fL':
+        if flags[2:] == '+' * 9:
+            changes['added'].append(name)
+        else:
+            changes['modified'].append(name)
+
+def parse_itemized(lines: Iterable[str]) -> ChangeSet:
+    """
+    Parse rsync `--out-format='%i %n'` output into the files it added, modified and deleted
+    """
+    changes: ChangeSet = {
+        "added": [],
+        "modified": [],
+        "deleted": []
+    }
+    for line in lines:
+        parse_item(line, changes)
+    return changes
         
-def rsync(repo: RepoConfig, path: PathConfig, config: RSyncConfig) -> str:   
-    cmd = ['rsync']
+def rsync(repo: RepoConfig, path: PathConfig, config: RSyncConfig, changes: Optional[ChangeSet] = None) -> Tuple[str, ChangeSet]:
+    """
+    Sync `path` into the repo, returns the destination and the files rsync changed,
+    relative to the destination directory (or the file's name when syncing a file)
+    
+    Changes are added to `changes` if given, eg. what an interrupted `fast_copy()` did.
+    """
+    # names as they are rather than escaped for the locale, only control characters are
+    cmd = ['rsync', '-8', '--out-format=%i %n']
     if config['archive']:
         cmd.append('-a')
     else: 
         cmd.append('-r')
-    
     local_path = path["local"]
     real_local = os.path.realpath(local_path)
     remote_path = resolve_remote(repo, path["remote"])
@@ -217,80 +821,228 @@ def rsync(repo: RepoConfig, path: PathConfig, config: RSyncConfig) -> str:
         
         log.info(f'rsync() local_dir={local_path} real_local={real_local} remote_dir={remote_path}')
        
+    filter_file = None
+    if config.get('delete', False):
+        cmd.append('--delete')
+        # never delete what git or git-backup keep next to the synced files
+        for protect in RSYNC_PROTECT:
+            cmd.append(f'--filter=P {protect}')
+        chunk_dirs = get_chunk_dirs(repo, remote_path)
+        if chunk_dirs:
+            # one rule per chunked file, read from a file rather than the command line
+            filter_file = tempfile.NamedTemporaryFile('w', encoding='utf8', errors='surrogateescape', prefix='git-backup-', suffix='.filter')
+            for chunk_dir in sorted(chunk_dirs):
+                # wildcards in the name match only themselves
+                pattern = RSYNC_WILDCARD.sub(r'\\\1', chunk_dir)
+                filter_file.write(f'P /{pattern}/***\n')
+            filter_file.flush()
+            cmd.append(f'--filter=merge {filter_file.name}')
     
     cmd.append(local_path)
     cmd.append(remote_path)
-    exec_sh(cmd)
+    # parsed as rsync reports them, its output is never held in full
+    if changes is None:
+        changes = parse_itemized([])
+    try:
+        proc.each_line(cmd, lambda line: parse_item(line, changes))
+    finally:
+        if filter_file is not None:
+            filter_file.close()
+    log.info(f'rsync() added={len(changes["added"])} modified={len(changes["modified"])} deleted={len(changes["deleted"])}')
+    return remote_path, changes
+
+def fast_copy(repo: RepoConfig, path: PathConfig, config: RSyncConfig, changes: ChangeSet) -> str:
+    """
+    Sync `path` into the repo like `rsync()` does, copying through the kernel rather
+    than rsync, returns the destination
+    
+    Files are reflinked where the filesystem supports it, so they share their blocks
+    with the source until either side changes. Otherwise they're copied with
+    `copy_file_range`/`sendfile`, without passing through user space.
+    """
+    local_path = path['local']
+    remote_path = resolve_remote(repo, path['remote'])
+    if os.path.isdir(local_path):
+        remote_path = remote_path.rstrip('/')
+    else:
+        mkdir_p(os.path.dirname(remote_path))
+    
+    log.info(f'fast_copy() local={local_path} remote={remote_path}')
+    chunk_dirs = get_chunk_dirs(repo, remote_path)
+    protect = lambda rel, is_dir: is_protected(rel, is_dir, chunk_dirs)
+    counts = fastcopy.sync_tree(local_path, remote_path, changes, config['archive'], config.get('delete', False), protect)
+    for strategy, count in counts.items():
+        metrics.inc('git_backup_copied_files_total', count, strategy=strategy)
+    strategies = ' '.join(f'{strategy}={count}' for strategy, count in counts.items()) or 'none'
+    log.info(f'fast_copy() added={len(changes["added"])} modified={len(changes["modified"])} deleted={len(changes["deleted"])} copied with {strategies}')
     return remote_path
 
-def git_rm(path: str, repo: RepoConfig, cached: bool = True):
+def copy_path(repo: RepoConfig, path: PathConfig, config: RSyncConfig) -> Tuple[str, ChangeSet]:
+    """
+    Sync `path` into the repo with `fast_copy()` when `rsync.reflink` is on and the
+    source is on the repo's filesystem, `rsync()` otherwise or if it fails
+    """
+    changes = parse_itemized([])
+    if config.get('reflink') and fastcopy.same_filesystem(path['local'], get_repo_path(repo)):
+        try:
+            return fast_copy(repo, path, config, changes), changes
+        except OSError as e:
+            log.warning(f'copy_path() fast copy failed, falling back to rsync path={path["local"]}: {e}')
+    elif config.get('reflink'):
+        log.info(f'copy_path() path={path["local"]} is on another filesystem, using rsync')
+    return rsync(repo, path, config, changes)
+
+def git_rm(paths: Union[str, List[str]], repo: RepoConfig, cached: bool = True):
+    if isinstance(paths, str):
+        paths = [paths]
+    if not paths:
+        return
     repo_path = get_repo_path(repo)
     
-    cmd = ["git", "rm"]
+    cmd = ["git", "rm", "-q"]
     if cached:
-        cmd.append("--cached")
-    cmd.append(path)
+        # excluded oversized files may never have been added, stale chunk directories
+        # are removed whole
+        cmd.extend(["--cached", "--ignore-unmatch", "-r"])
     
-    log.info(f'git_rm() cmd={" ".join(cmd)}')
-    return exec_sh(cmd, cwd=repo_path)
+    log.info(f'git_rm() cmd={" ".join(cmd)} {_describe(paths)}')
+    cmd, stdin = _pathspec(cmd, paths)
+    return exec_sh(cmd, cwd=repo_path, input=stdin)
     
-def oh_git_lfs(path: str, file_stat: os.stat_result, repo: RepoConfig) -> bool:
+def _batched(args: List[str], limit: int = ARG_BATCH_SIZE) -> Iterable[List[str]]:
+    """
+    Split `args` into runs whose combined length stays under `limit` bytes
+    """
+    batch: List[str] = []
+    size = 0
+    for arg in args:
+        if batch and size + len(arg) + 1 > limit:
+            yield batch
+            batch, size = [], 0
+        batch.append(arg)
+        size += len(arg) + 1
+    if batch:
+        yield batch
+
+def git_lfs_track(repo: RepoConfig, paths: List[str]):
+    """
+    Track `paths` with git lfs, in as few invocations as the command line allows
+    """
+    if not paths:
+        return
     repo_path = get_repo_path(repo)
-    rel_path = os.path.join('/', os.path.relpath(path, repo_path))
-    exec_sh(['git', 'lfs', 'track', rel_path], repo_path)
+    rel_paths = [os.path.join('/', os.path.relpath(path, repo_path)) for path in paths]
+    log.info(f'git_lfs_track() path={_describe(rel_paths)}')
+    for batch in _batched(rel_paths):
+        exec_sh(['git', 'lfs', 'track', *batch], repo_path)
+    
+def oh_git_lfs(path: str, file_stat: os.stat_result, repo: RepoConfig) -> bool:
+    git_lfs_track(repo, [path])
     return False
 
+def get_chunking_config(repo: RepoConfig) -> ChunkingConfig:
+    chunking_conf = repo.get('chunking') or {}
+    return {
+        "mode": chunking_conf.get('mode', DEFAULT_CHUNKING_MODE),
+        "avg_size": int(chunking_conf.get('avg_size', DEFAULT_CHUNK_AVG_SIZE)),
+        "buffer_size": int(chunking_conf.get('buffer_size', DEFAULT_CHUNK_BUFFER_SIZE)),
+        "workers": max(1, int(chunking_conf.get('workers', DEFAULT_CHUNK_WORKERS)))
+    }
+
 def oh_chunking(path: str, file_stat: os.stat_result, repo: RepoConfig) -> bool:
-    chunk_size = repo['max_file_size']
-    full_size = file_stat.st_size
-    fname = os.path.basename(path)
-    chunk_dir = f'{path}.d'
-    manifest_path = os.path.join(chunk_dir, 'manifest')
+    # keep the original out of the index for good, only its chunks are committed
+    git_exclude(repo, path)
     
-    # make directory to hold chunks
-    mkdir_p(chunk_dir)
-    
-    # hash of original file
-    hash = hashlib.sha256()
-    
-    # original oversized file
-    f = open(path, 'rb')
-    
-    chunk = f.read(chunk_size)
-    i = 0
-    while chunk:
-        hash.update(chunk)
-        
-        chunk_path = os.path.join(chunk_dir, str(i))
-        chunk_file = open(chunk_path, "wb")
-        chunk_file.write(chunk)
-        chunk_file.close()
-        
-        chunk = f.read(chunk_size)
-        i += 1
-    f.close()
-    
-    # update or create manifest
-    prev_version = 0
-    try:
-        with open(manifest_path, 'r', encoding='utf8') as manifest:
-            v_line: str = manifest.readline(1)
-            if v_line and v_line.startswith('version '):
-                prev_version = int(v_line.split(' ')[1].strip())
-    except Exception as e:
-        if not isinstance(e, IOError) or e.errno != 2:
-            log.warn(f'oh_chunking() could not read manifest {e}')
-            
-    with open(manifest_path, 'w', encoding='utf8') as manifest:
-        manifest.write(f'''\
-version {prev_version + 1}
-name {fname}
-oid sha256:{hash.hexdigest()}
-size {full_size}
-chunks {i}
-''')
+    config = get_chunking_config(repo)
+    if config['mode'] == 'cdc':
+        manifest = chunking.chunk_cdc(path, get_repo_path(repo), config, repo['max_file_size'])
+    else:
+        manifest = chunking.chunk_fixed(path, repo['max_file_size'], config['buffer_size'], config['workers'])
+    metrics.inc('git_backup_bytes_total', manifest['size'], kind='chunked')
     return True
+
+def get_shrunk(repo: RepoConfig, change_file: str, changed_paths: Optional[List[str]], uncache_paths: List[str]) -> List[str]:
+    """
+    Files of a materialized path that were chunked once and are back under `max_file_size`
+    """
+    excluded = get_excluded(repo)
+    if not excluded:
+        return []
+    if changed_paths is not None:
+        candidates = [p for p in changed_paths if p in excluded]
+    else:
+        prefix = os.path.join(change_file, '')
+        candidates = [p for p in excluded if p == change_file or p.startswith(prefix)]
     
+    uncached = set(uncache_paths)
+    shrunk = []
+    for path in candidates:
+        if path in uncached or not os.path.isfile(path):
+            continue
+        if os.path.getsize(path) <= repo['max_file_size']:
+            shrunk.append(path)
+    return shrunk
+
+def get_manifests(repo: RepoConfig) -> Optional[List[Manifest]]:
+    """
+    Every chunk manifest in the repo's index, None if any of them can't be read
+
+    Read from the work tree where checked out, from the index otherwise, eg. outside
+    the directories of a sparse checkout.
+    """
+    repo_path = get_repo_path(repo)
+    out = exec_sh(["git", "ls-files", "-z", "--", f'*.d/{chunking.MANIFEST_NAME}'], cwd=repo_path)
+    manifests = []
+    missing = []
+    for rel in filter(None, out.split('\0')):
+        manifest_path = os.path.join(repo_path, rel)
+        if not os.path.exists(manifest_path):
+            missing.append(rel)
+            continue
+        manifest = chunking.read_manifest(manifest_path)
+        if manifest is None:
+            return None
+        manifests.append(manifest)
+
+    if missing:
+        out = exec_sh(["git", "cat-file", "--batch"], cwd=repo_path, input=''.join(f':{rel}\n' for rel in missing), binary=True)
+        pos = 0
+        while pos < len(out):
+            end = out.index(b'\n', pos)
+            header = out[pos:end].split(b' ')
+            pos = end + 1
+            if header[-1] == b'missing':
+                log.warning(f'get_manifests() could not read manifest {header[0].decode("utf8", "surrogateescape")}')
+                return None
+            size = int(header[2])
+            try:
+                manifests.append(chunking.parse_manifest(out[pos:pos + size].decode('utf8')))
+            except ValueError as e:
+                log.warning(f'get_manifests() could not read manifest {header[0].decode("ascii")}: {e}')
+                return None
+            pos += size + 1
+    return manifests
+
+def prune_chunk_store(repo: RepoConfig):
+    """
+    Delete chunks no manifest references any more from the store and the index, eg.
+    those of a previous version of a changed file
+
+    Runs once every path of the work tree is staged, when no chunks are being written.
+    """
+    store_path = os.path.join(get_repo_path(repo), chunking.CHUNK_STORE_DIR)
+    if repo['git']['add'] == False or not os.path.isdir(store_path):
+        return
+    manifests = get_manifests(repo)
+    if manifests is None:
+        log.warning('prune_chunk_store() some manifests are unreadable, keeping every chunk')
+        return
+    referenced = {oid for manifest in manifests for oid, _ in manifest['chunk_list']}
+    removed = chunking.prune_store(store_path, referenced)
+    if removed:
+        log.info(f'prune_chunk_store() removing {len(removed)} unreferenced chunks')
+        git_rm(removed, repo, cached=True)
+
 def get_oversize_handler(handler_t: OversizeHandlerType) -> OversizeHandler:
     if handler_t == "git_lfs":
         return oh_git_lfs
@@ -300,50 +1052,401 @@ def get_oversize_handler(handler_t: OversizeHandlerType) -> OversizeHandler:
     log.warn(f'Invalid oversize_handler type: {handler_t}')
     return lambda *_: False
     
-def sync(conf: Config):
+def get_sync_config(conf: Config) -> SyncConfig:
+    sync_conf = conf.get('sync') or {}
+    return {
+        "workers": max(1, int(sync_conf.get('workers', DEFAULT_SYNC_WORKERS))),
+        "per_host": max(0, int(sync_conf.get('per_host', DEFAULT_SYNC_PER_HOST))),
+        "index": bool(sync_conf.get('index', DEFAULT_SYNC_INDEX)),
+        "worktrees": bool(sync_conf.get('worktrees', DEFAULT_SYNC_WORKTREES)),
+        "branch_workers": max(1, int(sync_conf.get('branch_workers', DEFAULT_SYNC_BRANCH_WORKERS))),
+        "timeout": max(0, float(sync_conf.get('timeout', DEFAULT_SYNC_TIMEOUT))),
+        "pipeline": max(0, int(sync_conf.get('pipeline', DEFAULT_SYNC_PIPELINE)))
+    }
+
+def get_metrics_config(conf: Config) -> MetricsConfig:
+    metrics_conf = conf.get('metrics') or {}
+    return {
+        "port": int(metrics_conf.get('port', DEFAULT_METRICS_PORT)),
+        "textfile": metrics_conf.get('textfile')
+    }
+
+def get_repo_host(repo: RepoConfig) -> str:
+    endpoint = repo.get('endpoint') or DEFAULT_ENDPOINT
+    return urlparse(endpoint).netloc or endpoint
+
+def is_materialized(repo: RepoConfig, path: PathConfig) -> bool:
     """
-    Sync changes into repository
+    Whether `path` is in the repo's work tree, as a file, directory or archive, or as
+    the chunks of an archive streamed into them
     """
-    for repo in conf['repos']:
-        repo_path = get_repo_path(repo)
-        log.debug(f'sync() start repo_path={repo_path}')
+    dest = get_sync_dest(repo, path)
+    return os.path.exists(dest) or (bool(path['compress']) and get_archive_manifest(dest) is not None)
+
+def materialize_path(repo: RepoConfig, path: PathConfig, conf: Config) -> Optional[PathWork]:
+    """
+    Copy or archive a path into the repo's work tree, returns None if it is unchanged
+    since the last sync
+    """
+    repo_path = get_repo_path(repo)
+    state_path = get_state_path(repo)
+    
+    key = get_index_key(repo, path, get_archive_config(conf))
+    snapshot: Optional[Snapshot] = None
+    # source changes since the last completed sync of the path, from the index
+    index_changes: Optional[ChangeSet] = None
+    if get_sync_config(conf)['index']:
+        snapshot = index.scan(path['local'])
+        prev_snapshot = index.load(state_path, key)
+        if prev_snapshot is not None:
+            index_changes = index.diff(prev_snapshot, snapshot)
+            if index.is_empty(index_changes) and is_materialized(repo, path):
+                log.info(f'sync_repo() no changes since last sync, skipping path={path["local"]}')
+                return None
+            log.info(f'sync_repo() path={path["local"]} added={len(index_changes["added"])} modified={len(index_changes["modified"])} deleted={len(index_changes["deleted"])}')
+    
+    changed_paths: Optional[List[str]] = None
+    deleted_paths: List[str] = []
+    chunked_paths: List[str] = []
+    pending_path = os.path.join(state_path, 'pending', index.index_key(path))
+    
+    if path['compress']:
+        # if compressing, zip the path directly into the repo directory, overwrite existing
+        with metrics.timer('materialize', path=path['remote']):
+            archive_name = compress(repo, path, get_archive_config(conf))
+        manifest = get_archive_manifest(archive_name)
+        if manifest is None:
+            metrics.inc('git_backup_bytes_total', os.path.getsize(archive_name), kind='archived')
+        else:
+            # streamed into chunks, there's no whole archive to size check
+            chunked_paths.append(archive_name)
+            metrics.inc('git_backup_bytes_total', manifest['size'], kind='archived')
+            metrics.inc('git_backup_bytes_total', manifest['size'], kind='chunked')
+        change_path = os.path.relpath(archive_name, repo_path)
+    else:
+        # otherwise, use rsync (or a kernel copy) to pull changes into repo
+        # a leftover marker means the last sync of this path never finished staging,
+        # rsync won't report those files again, so fall back to staging the whole path
+        incomplete = os.path.exists(pending_path)
+        mkdir_p(os.path.dirname(pending_path))
+        open(pending_path, 'w').close()
         
-        mkdir_p(repo_path)
+        with metrics.timer('materialize', path=path['remote']):
+            change_path, rsync_changes = copy_path(repo, path, conf['rsync'])
+        if os.path.isdir(change_path):
+            copied = [os.path.join(change_path, rel) for rel in rsync_changes['added'] + rsync_changes['modified']]
+        else:
+            copied = [change_path] if rsync_changes['added'] or rsync_changes['modified'] else []
+        metrics.inc('git_backup_bytes_total', sum(st.st_size for _, st in walk_paths(copied)), kind='transferred')
         
+        if not incomplete:
+            changed_paths = copied
+            if os.path.isdir(change_path):
+                deleted_paths = [os.path.join(change_path, rel) for rel in rsync_changes['deleted']]
+        elif index_changes is not None:
+            # the index hasn't moved since the last completed sync, its changes include
+            # whatever the interrupted one copied
+            log.info(f'sync_repo() staging changes since the last completed sync, path={path["local"]}')
+            if os.path.isdir(change_path):
+                changed_paths = [os.path.join(change_path, rel) for rel in index_changes['added'] + index_changes['modified']]
+                if conf['rsync'].get('delete', False):
+                    deleted_paths = [os.path.join(change_path, rel) for rel in index_changes['deleted']]
+            else:
+                changed_paths = [change_path] if index_changes['added'] or index_changes['modified'] else []
+    
+    return {
+        "path": path,
+        "change_path": change_path,
+        "changed_paths": changed_paths,
+        "deleted_paths": deleted_paths,
+        "chunked_paths": chunked_paths,
+        "pending_path": pending_path,
+        "snapshot": snapshot,
+        "index_key": key,
+        "rm_paths": [],
+        "add_paths": [],
+        "extra_paths": [],
+        "lfs_paths": []
+    }
+
+def check_path(repo: RepoConfig, work: PathWork) -> PathWork:
+    """
+    Handle oversized files of a materialized path and work out what to stage
+    """
+    with metrics.timer('check', path=work['path']['remote']):
+        return _check_path(repo, work)
+
+def _check_path(repo: RepoConfig, work: PathWork) -> PathWork:
+    repo_path = get_repo_path(repo)
+    change_path = work['change_path']
+    changed_paths = work['changed_paths']
+    
+    lfs_paths = work['lfs_paths']
+    if repo['oversize_handler'] == 'git_lfs':
+        # collect oversized files, they are tracked all at once while staging
+        oversize_handler = lambda p, *_: lfs_paths.append(p) or False
+    else:
+        oversize_handler = get_oversize_handler(repo['oversize_handler'])
+    uncache_paths = work['chunked_paths'] + check_sizes(repo, change_path, oversize_handler, changed_paths)
+    
+    # everything this path needs staged, in one `git rm` and one `git add`
+    work['rm_paths'] = work['deleted_paths'] + uncache_paths
+    # staged alongside the synced files, eg. chunks of an archive live next to it
+    extra_paths = work['extra_paths']
+    
+    if repo['oversize_handler'] == 'git_lfs':
+        extra_paths.append('.gitattributes')
+    elif repo['oversize_handler'] == 'chunking':
+        extra_paths.extend(f'{p}.d' for p in uncache_paths)
+        if uncache_paths and get_chunking_config(repo)['mode'] == 'cdc':
+            # another path may be writing chunks to the store while this one is staged
+            git_exclude(repo, os.path.join(repo_path, chunking.CHUNK_TMP_PATTERN))
+            extra_paths.append(chunking.CHUNK_STORE_DIR)
+    
+    change_file = os.path.join(repo_path, change_path)
+    for path in get_shrunk(repo, change_file, changed_paths, uncache_paths):
+        # no longer oversized, adding it fails (or a directory add skips it) while excluded
+        git_exclude(repo, path, False)
+        chunk_dir = f'{path}.d'
+        if os.path.isdir(chunk_dir):
+            # chunks of the old version, a restore would put them back over the new file
+            log.info(f'sync_repo() {path} is back under max_file_size, removing its chunks')
+            shutil.rmtree(chunk_dir)
+            work['rm_paths'].append(chunk_dir)
+    
+    if changed_paths is not None:
+        # stage exactly what rsync changed
+        work['add_paths'] = [p for p in changed_paths if p not in uncache_paths]
+    elif change_file in uncache_paths:
+        # a single chunked file, only its chunks are added
+        pass
+    else:
+        work['add_paths'] = [change_path]
+    return work
+
+def stage_path(repo: RepoConfig, work: PathWork):
+    """
+    Stage a checked path, the only step touching the repo's index
+    """
+    with metrics.timer('stage', path=work['path']['remote']):
+        _stage_path(repo, work)
+
+def _stage_path(repo: RepoConfig, work: PathWork):
+    change_path = work['change_path']
+    
+    if work['lfs_paths']:
+        git_lfs_track(repo, work['lfs_paths'])
+    
+    # chunked originals leave the index before their chunk directories are added
+    git_rm(work['rm_paths'], repo, cached=True)
+    try:
+        git_add(repo, *work['add_paths'], *work['extra_paths'])
+    except RuntimeError:
+        if work['changed_paths'] is None:
+            raise
+        # eg. a changed file matched a .gitignore, let git sort out the whole path
+        log.warning(f'sync_repo() staging changed files failed, adding path={change_path}')
+        git_add(repo, change_path, *work['extra_paths'])
+    
+    if os.path.exists(work['pending_path']):
+        os.remove(work['pending_path'])
+    
+    if work['snapshot'] is not None:
+        index.save(get_state_path(repo), work['index_key'], work['snapshot'])
+
+def sync_path(repo: RepoConfig, path: PathConfig, conf: Config):
+    """
+    Sync a single path into the repo's work tree and stage it, without committing
+    """
+    work = materialize_path(repo, path, conf)
+    if work is not None:
+        stage_path(repo, check_path(repo, work))
+
+def sync_paths(repo: RepoConfig, paths: List[PathConfig], conf: Config):
+    """
+    Sync paths that share a work tree, staged in order
+    
+    With `sync.pipeline` the materialize, check and stage steps run as a pipeline,
+    so copying or archiving the next path overlaps with git staging the previous one.
+    """
+    depth = get_sync_config(conf)['pipeline']
+    if depth <= 0 or len(paths) < 2:
+        for path in paths:
+            sync_path(repo, path, conf)
+    else:
+        pipeline.run_pipeline(paths, [
+            lambda path: materialize_path(repo, path, conf),
+            lambda work: check_path(repo, work),
+            lambda work: stage_path(repo, work)
+        ], depth, name='path')
+    
+    # chunks of replaced or removed versions, the store is shared by every path
+    prune_chunk_store(repo)
+
+def get_path_branch(repo: RepoConfig, path: PathConfig) -> str:
+    return path['branch'] if 'branch' in path and path['branch'] is not None else repo['branch']
+
+def sync_branch(repo: RepoConfig, branch: str, paths: List[PathConfig], conf: Config) -> bool:
+    """
+    Sync `paths` into the worktree of `branch` and commit them, returns whether it committed
+    """
+    with log_context(f'{repo["owner"]}/{repo["name"]}@{branch}'):
+        branch_repo = git_worktree(repo, branch)
+        sync_paths(branch_repo, paths, conf)
+        return commit_changes(branch_repo)
+
+def sync_repo(repo: RepoConfig, conf: Config, paths: Optional[List[PathConfig]] = None):
+    """
+    Sync changes into a single repository, only `paths` of its paths if given
+    
+    With `sync.worktrees` every branch gets its own work tree, otherwise paths on
+    other branches are synced by switching the repo's single work tree.
+    """
+    if paths is None:
+        paths = repo['paths']
+    repo_path = get_repo_path(repo)
+    log.debug(f'sync_repo() start repo_path={repo_path}')
+    
+    mkdir_p(repo_path)
+    
+    with metrics.timer('fetch'):
         git_fetch(repo, conf['secrets'])
-        cur_branch = repo['branch']
+    sync_conf = get_sync_config(conf)
+    committed: List[str] = []
+    
+    if sync_conf['worktrees']:
+        # paths grouped by branch, in the order branches first appear
+        branch_paths: Dict[str, List[PathConfig]] = {}
+        for path in paths:
+            branch_paths.setdefault(get_path_branch(repo, path), []).append(path)
         
-        for path in repo['paths']:
-            next_branch = path['branch'] if 'branch' in path and path['branch'] is not None else cur_branch
-            
+        workers = min(sync_conf['branch_workers'], len(branch_paths))
+        if workers <= 1:
+            results = [sync_branch(repo, b, p, conf) for b, p in branch_paths.items()]
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='branch') as pool:
+                # carry this thread's context, eg. the command timeout, into the workers
+                futures = [pool.submit(contextvars.copy_context().run, sync_branch, repo, b, p, conf) for b, p in branch_paths.items()]
+                results = [f.result() for f in futures]
+        committed = [b for b, did_commit in zip(branch_paths, results) if did_commit]
+    else:
+        cur_branch = repo['branch']
+        # runs of consecutive paths on the same branch
+        for next_branch, branch_paths in groupby(paths, lambda path: get_path_branch(repo, path)):
             if next_branch != cur_branch:
+                # staged changes would follow us to the next branch
+                if commit_changes(repo) and cur_branch not in committed:
+                    committed.append(cur_branch)
                 git_checkout(repo, next_branch, conf['secrets'])
                 cur_branch = next_branch
             
-            if path['compress']:
-                # if compressing, zip the path directly into the repo directory, overwrite existing
-                archive_name = compress(repo, path)
-                change_path = os.path.relpath(archive_name, repo_path)
-            else:
-                # otherwise, use rsync to pull changes into repo
-                change_path = rsync(repo, path, conf['rsync'])
-               
-            oversize_handler = get_oversize_handler(repo['oversize_handler'])
-            uncache_paths = check_sizes(repo, change_path, oversize_handler)
-            
-            if repo['oversize_handler'] == 'git_lfs':
-                git_add(repo, '.gitattributes')
-            git_add(repo, change_path)
-            
-            for p in uncache_paths:
-                git_rm(p, repo, cached=True)
+            sync_paths(repo, list(branch_paths), conf)
                         
-        status = git_status(repo, True)
-        if status:
-            log.debug(f'sync() git_status: \n{git_status(repo)}')
-            log.info(f'sync() git_status (porcelain): \n{status}')
-            git_commit(repo)
-            git_push(repo)
-            log.info('done sync')
-        else:
-            log.info(f'sync() no changes, skipping commit to {repo["owner"]}/{repo["name"]}')
\ No newline at end of file
+        if commit_changes(repo) and cur_branch not in committed:
+            committed.append(cur_branch)
+    
+    if not committed:
+        log.info(f'sync_repo() no changes, skipping commit to {repo["owner"]}/{repo["name"]}')
+    
+    # includes commits a previous cycle held back
+    unpushed = get_unpushed_branches(repo)
+    if not unpushed:
+        log.info('sync_repo() remote up to date, skipping push')
+    elif conf['loop']['loop'] and not push_due(repo):
+        log.info(f'sync_repo() holding back push of branches={",".join(unpushed)}')
+    else:
+        with metrics.timer('push'):
+            git_push(repo, unpushed, conf['secrets'])
+        log.info('done sync')
+
+def commit_changes(repo: RepoConfig) -> bool:
+    """
+    Commit the current branch if anything changed, returns whether it did
+    
+    Only the index is compared against HEAD, everything to commit is staged by now,
+    so the work tree isn't scanned again.
+    """
+    staged = git_staged(repo)
+    if not staged:
+        return False
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f'sync_repo() git_status: \n{git_status(repo)}')
+    log.info(f'sync_repo() staged changes: \n{staged}')
+    with metrics.timer('commit'):
+        git_commit(repo)
+    return True
+
+def get_host_limits(conf: Config) -> Dict[str, threading.BoundedSemaphore]:
+    """
+    One semaphore per endpoint host when `sync.per_host` limits them
+    """
+    per_host = get_sync_config(conf)['per_host']
+    host_limits: Dict[str, threading.BoundedSemaphore] = {}
+    if per_host > 0:
+        for repo in conf['repos']:
+            host_limits.setdefault(get_repo_host(repo), threading.BoundedSemaphore(per_host))
+    return host_limits
+
+def run_repo(repo: RepoConfig, conf: Config, limit: Optional[threading.BoundedSemaphore] = None, paths: Optional[List[PathConfig]] = None) -> bool:
+    """
+    Sync a single repo (or `paths` of it) with its log context, metric labels, command
+    timeout and host limit applied, returns whether it succeeded
+    """
+    name = f'{repo["owner"]}/{repo["name"]}'
+    with log_context(name), metrics.metric_labels(repo=name), proc.command_timeout(get_sync_config(conf)['timeout']):
+        start = time.perf_counter()
+        try:
+            if limit is None:
+                with metrics.timer('repo'):
+                    sync_repo(repo, conf, paths)
+            else:
+                with limit, metrics.timer('repo'):
+                    sync_repo(repo, conf, paths)
+        except Exception as e:
+            log.error(f'ERROR: sync() failed to sync repo: {name}. \nError: {e}')
+            metrics.inc('git_backup_repo_failures_total')
+            return False
+        finally:
+            metrics.set_gauge('git_backup_repo_last_sync_seconds', time.perf_counter() - start)
+        metrics.set_gauge('git_backup_repo_last_success_timestamp_seconds', time.time())
+        return True
+
+def write_metrics(conf: Config):
+    textfile = get_metrics_config(conf)['textfile']
+    if textfile:
+        metrics.write_textfile(textfile)
+
+def sync(conf: Config):
+    """
+    Sync changes into repositories
+    
+    Up to `sync.workers` repos are synced concurrently, with at most `sync.per_host` 
+    of them talking to the same endpoint host. A failing repo does not stop the others,
+    failures are raised together once every repo has finished.
+    """
+    sync_conf = get_sync_config(conf)
+    repos = conf['repos']
+    host_limits = get_host_limits(conf)
+    failures: List[str] = []
+    
+    def _sync_repo(repo: RepoConfig):
+        if not run_repo(repo, conf, host_limits.get(get_repo_host(repo))):
+            failures.append(f'{repo["owner"]}/{repo["name"]}')
+    
+    start = time.perf_counter()
+    workers = min(sync_conf['workers'], len(repos))
+    if workers <= 1:
+        for repo in repos:
+            _sync_repo(repo)
+    else:
+        log.info(f'sync() syncing {len(repos)} repos with {workers} workers')
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sync') as pool:
+            list(pool.map(_sync_repo, repos))
+    
+    metrics.set_gauge('git_backup_cycle_seconds', time.perf_counter() - start)
+    if not failures:
+        metrics.set_gauge('git_backup_last_success_timestamp_seconds', time.time())
+    write_metrics(conf)
+    
+    if failures:
+        raise RuntimeError(f'Failed to sync repos: {", ".join(failures)}')
@@ -1,44 +1,100 @@
 from os import stat_result
-from typing import TYPE_CHECKING, Callable, List, Literal, Mapping, Optional, Union, TypedDict
+from typing import TYPE_CHECKING, Callable, Dict, List, Literal, Mapping, Optional, Tuple, Union, TypedDict
 
 from git_backup.cron import Cron
 
 if TYPE_CHECKING:
     from git_backup.secrets import Secrets
 
-CompressType = Union[Literal['zip'], Literal['tar'], Literal['gztar'], Literal['bztar'], Literal['xztar']]
+CompressType = Union[Literal['zip'], Literal['tar'], Literal['gztar'], Literal['bztar'], Literal['xztar'], Literal['pgztar'], Literal['zstdtar']]
 
-OversizeHandlerType = Union[Literal['git_lfs'], Literal['chunk']]
+OversizeHandlerType = Union[Literal['git_lfs'], Literal['chunking']]
+
+ChunkerType = Union[Literal['fixed'], Literal['cdc']]
 
 # (path, file_stat, repo) => rm_from_git_cache
 OversizeHandler = Callable[[str, stat_result, 'RepoConfig'], bool]
 
+# relative path -> [mtime_ns, size, inode]
+Snapshot = Dict[str, List[int]]
+
+class ChangeSet(TypedDict):
+    # paths relative to the synced root
+    added: List[str]
+    modified: List[str]
+    deleted: List[str]
+
 class PathConfig(TypedDict):
     local: str
     remote: str
     compress: Optional[CompressType]
     branch: Optional[str]
+    schedule: Optional[Cron] # synced on its own schedule rather than the repo's
+    interval: Optional[float] # minutes, synced on its own interval rather than the repo's
+
+class PathWork(TypedDict):
+    # a path on its way through sync_repo()'s materialize, check and stage steps
+    path: PathConfig
+    change_path: str # synced file or directory in the repo
+    changed_paths: Optional[List[str]] # files rsync changed, None to stage all of `change_path`
+    deleted_paths: List[str]
+    chunked_paths: List[str] # archives streamed into chunks while materializing
+    pending_path: str # marker removed once staged
+    snapshot: Optional[Snapshot] # source index saved once staged
+    index_key: str # what the snapshot is saved under
+    rm_paths: List[str]
+    add_paths: List[str]
+    extra_paths: List[str]
+    lfs_paths: List[str]
     
 class GitConfig(TypedDict):
     add: Optional[bool] # default True
     commit: Optional[bool] # default True
     push: Optional[bool] # default True
     force_push: Optional[bool] # default False
+    push_window: Optional[float] # seconds, commits are pushed at most this often while looping, default 0
     message: Optional[str] # default `chore(backup): update backup`
     email: Optional[str]
     name: Optional[str]
+    clone_filter: Optional[str] # partial clone filter for the first clone, eg. `blob:none`
+    sparse: Optional[bool] # only check out the directories paths sync into, default False
+    credential_helper: Optional[bool] # pass the token through a credential helper rather than the URL, default False
+    many_files: Optional[bool] # tune the index for large work trees (index v4, untracked cache), default False
+
+
+class ChunkingConfig(TypedDict):
+    mode: ChunkerType # default `fixed`
+    avg_size: int # target chunk size for `cdc`, bytes
+    buffer_size: int # read buffer for `fixed`, bytes
+    workers: int # threads splitting a single file for `fixed`, default 1
 
+# (oid, size)
+ChunkEntry = Tuple[str, int]
+
+class Manifest(TypedDict):
+    version: int
+    name: str
+    oid: str # sha256:<hex> of the whole file
+    size: int
+    chunks: int
+    chunker: ChunkerType
+    store: Optional[str] # chunk store, relative to the manifest's directory
+    chunk_list: List[ChunkEntry]
     
 class RepoConfig(TypedDict):
     name: str
     owner: str
     storage_root: str
     endpoint: Optional[str]
+    api_base: Optional[str]
     paths: List[PathConfig]
     branch: Optional[str]
     git: GitConfig
     max_file_size: int # bytes
     oversize_handler: OversizeHandlerType
+    chunking: Optional[ChunkingConfig]
+    schedule: Optional[Cron] # overrides `loop.schedule` for this repo
+    interval: Optional[float] # minutes, overrides `loop.interval` for this repo
     
 class RepoSecrets(TypedDict):
     token: Optional[str]
@@ -50,17 +106,43 @@ class LoopConfig(TypedDict):
     loop: bool # whether to loop
     interval: float # minutes, default=1440 (1 day)
     schedule: Optional[Cron]
+    jitter: Optional[float] # minutes, each sync starts up to this much later, default 0
+    watch: Optional[float] # seconds between checks of config.yaml and secrets.yaml for changes, 0=off
     
 class StorageConfig(TypedDict):
     repo_root: str
     
 class RSyncConfig(TypedDict):
     archive: bool
+    delete: Optional[bool] # delete files removed at the source, default False
+    reflink: Optional[bool] # copy through the kernel (reflinks where supported) when on the same filesystem, default False
+    
+class ArchiveConfig(TypedDict):
+    deterministic: bool # reproducible archives, only rebuilt when inputs change. default False
+    level: Optional[int] # compression level, default depends on the archive type
+    threads: int # cores used by `pgztar`/`zstdtar`, 0=all
+    stream: Optional[bool] # write oversized archives straight into chunks, default False
+    
+class SyncConfig(TypedDict):
+    workers: int # repos synced concurrently, default=1
+    per_host: int # max concurrent repos per endpoint host, 0=unlimited
+    index: bool # skip paths whose source is unchanged since the last sync, default False
+    worktrees: bool # give every branch its own persistent work tree, default False
+    branch_workers: int # branches of a repo synced concurrently with `worktrees`, default=1
+    timeout: float # seconds any single git/rsync command may run, 0=no limit
+    pipeline: int # paths queued between materialize, check and stage steps, 0=one path at a time
+
+class MetricsConfig(TypedDict):
+    port: int # serve Prometheus metrics on this port, 0=off
+    textfile: Optional[str] # also write them here after every cycle, for node_exporter's textfile collector
 
 class Config(TypedDict):
     version: int
     storage: StorageConfig
     rsync: RSyncConfig
+    archive: Optional[ArchiveConfig]
+    sync: Optional[SyncConfig]
+    metrics: Optional[MetricsConfig]
     repos: List[RepoConfig]
     secrets: 'Secrets'
     loop: LoopConfig
\ No newline at end of file
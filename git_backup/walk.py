@@ -0,0 +1,43 @@
+import os
+import stat
+from typing import Collection, Iterable, Iterator, Tuple
+
+SKIP_DIRS = ('.git',)
+
+def walk(root: str, skip: Collection[str] = SKIP_DIRS, follow_symlinks: bool = True) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Yield (path, stat) for every file below `root` from a single iterative scandir pass
+
+    Directories named in `skip` are not entered, symlinked directories are never
+    followed. File type comes from the cached `DirEntry` info, so each file costs
+    at most one stat. If `root` is a file, it is the only result.
+    """
+    if not os.path.isdir(root):
+        if os.path.lexists(root):
+            yield root, os.stat(root, follow_symlinks=follow_symlinks)
+        return
+
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in skip:
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=follow_symlinks):
+                    yield entry.path, entry.stat(follow_symlinks=follow_symlinks)
+                elif not follow_symlinks and entry.is_symlink():
+                    yield entry.path, entry.stat(follow_symlinks=False)
+
+def walk_paths(paths: Iterable[str], follow_symlinks: bool = True) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Yield (path, stat) for the files in `paths`, eg. a list of changed files,
+    skipping any that no longer exist
+    """
+    for path in paths:
+        try:
+            st = os.stat(path, follow_symlinks=follow_symlinks)
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            yield path, st
\ No newline at end of file
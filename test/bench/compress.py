@@ -0,0 +1,89 @@
+"""
+Compare throughput and ratio of the archive types on a synthetic tree
+
+    python test/bench/compress.py [--size-mb 256] [--threads 0] [--level N] [--out results.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from git_backup import archive
+
+WORDS = b'backup git chunk archive manifest rsync commit push branch worktree index sync'.split()
+
+def make_tree(root: str, size: int):
+    """
+    Half compressible text, half random bytes, spread over a few directories
+    """
+    per_file = 4 * 1024 * 1024
+    written = 0
+    i = 0
+    while written < size:
+        dir_path = os.path.join(root, 'src', f'd{i % 8}')
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, f'f{i}'), 'wb') as f:
+            if i % 2:
+                f.write(os.urandom(per_file))
+            else:
+                line = b' '.join(WORDS[(i + j) % len(WORDS)] for j in range(16)) + b'\n'
+                f.write((line * (per_file // len(line) + 1))[:per_file])
+        written += per_file
+        i += 1
+    return written
+
+def run(types: list, size: int, level: int, threads: int) -> list:
+    results = []
+    root = tempfile.mkdtemp(prefix='git-backup-bench-')
+    try:
+        total = make_tree(root, size)
+        entries = archive.list_entries(root, 'src')
+        for archive_type in types:
+            if archive_type == 'zstdtar' and archive.zstandard is None:
+                print(f'skipping {archive_type}, `zstandard` not installed', file=sys.stderr)
+                continue
+            dest = os.path.join(root, f'out.{archive_type}')
+            start = time.perf_counter()
+            if archive_type in archive.PARALLEL_TYPES or level is not None:
+                archive.make_archive(dest, archive_type, entries, level, threads)
+            else:
+                # baseline, as `compress()` does without deterministic mode
+                dest = shutil.make_archive(dest, archive_type, root, 'src')
+            elapsed = time.perf_counter() - start
+            out_size = os.path.getsize(dest)
+            os.remove(dest)
+            results.append({
+                "type": archive_type,
+                "input_bytes": total,
+                "output_bytes": out_size,
+                "ratio": round(total / out_size, 3),
+                "seconds": round(elapsed, 3),
+                "mb_per_s": round(total / elapsed / 1024 / 1024, 1)
+            })
+    finally:
+        shutil.rmtree(root)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark archive types')
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--types', default='zip,tar,gztar,bztar,xztar,pgztar,zstdtar')
+    parser.add_argument('--level', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--out', default=None, help='write results as JSON to this path')
+    args = parser.parse_args()
+
+    results = run(args.types.split(','), args.size_mb * 1024 * 1024, args.level, args.threads)
+    for r in results:
+        print(f'{r["type"]:>8}  {r["mb_per_s"]:>8} MB/s  ratio {r["ratio"]:>6}  {r["seconds"]}s')
+    if args.out:
+        with open(args.out, 'w', encoding='utf8') as stream:
+            json.dump(results, stream, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""
+Time `sync()` end to end against a local bare repo, on a synthetic tree of many small
+files, deep nesting and a few huge files
+
+    python test/bench/sync.py [--small-files 2000] [--huge-mb 64] [--sync pipeline=2] [--out results.json] [--compare old.json]
+
+Reports wall time per scenario (first sync, unchanged, small change), time and calls per
+stage, subprocesses by command, read/write syscalls and peak memory. Stages nest, eg.
+`compress` runs inside `materialize_path`, so their times don't add up to the total.
+"""
+import argparse
+import functools
+import importlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+# keep the per command INFO lines out of the results
+os.environ.setdefault('LOG_LEVEL', '3')
+
+from git_backup import proc
+from git_backup.secrets import Secrets
+from git_backup.walk import walk
+# `git_backup.sync` the module, not the function of the same name
+sync = importlib.import_module('git_backup.sync')
+
+STAGES = (
+    'git_fetch', 'materialize_path', 'compress', 'rsync', 'check_path', 'check_sizes',
+    'oh_chunking', 'stage_path', 'git_rm', 'git_add', 'commit_changes', 'git_push'
+)
+
+class Stats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.commands = {}
+
+    def add_stage(self, name: str, seconds: float):
+        with self.lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+
+    def add_command(self, cmd: list):
+        name = proc.command_name(cmd)
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+
+    def reset(self):
+        self.stages = {}
+        self.commands = {}
+
+def instrument(stats: Stats):
+    """
+    Wrap the pipeline's stages and the subprocess layer, calls go through module globals
+    so patching the modules is enough
+    """
+    def _timed(name, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stats.add_stage(name, time.perf_counter() - start)
+        return wrapper
+
+    for name in STAGES:
+        setattr(sync, name, _timed(name, getattr(sync, name)))
+
+    def _counted(fn):
+        @functools.wraps(fn)
+        def wrapper(cmd, *args, **kwargs):
+            stats.add_command(cmd)
+            return fn(cmd, *args, **kwargs)
+        return wrapper
+
+    proc.run_sync = _counted(proc.run_sync)
+    proc.each_line = _counted(proc.each_line)
+
+def sh(*cmd, cwd=None) -> str:
+    return subprocess.run(cmd, cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+def make_remote(root: str, branch: str) -> str:
+    """
+    Bare repo with a single commit, reachable at `file://<root>/remote/bench/backup.git`
+    """
+    bare = os.path.join(root, 'remote', 'bench', 'backup.git')
+    seed = os.path.join(root, 'seed')
+    sh('git', 'init', '-q', '--bare', '-b', branch, bare)
+    sh('git', 'config', 'uploadpack.allowFilter', 'true', cwd=bare)
+    sh('git', 'init', '-q', '-b', branch, seed)
+    with open(os.path.join(seed, 'README'), 'w') as f:
+        f.write('benchmark\n')
+    sh('git', 'add', '.', cwd=seed)
+    sh('git', '-c', 'user.email=bench@example', '-c', 'user.name=bench', 'commit', '-qm', 'init', cwd=seed)
+    sh('git', 'push', '-q', bare, f'{branch}:{branch}', cwd=seed)
+    shutil.rmtree(seed)
+    return bare
+
+def make_small(root: str, count: int, depth: int):
+    """
+    `count` small files, half in a flat directory and half down a `depth` deep chain
+    """
+    for i in range(count):
+        if i % 2:
+            dir_path = os.path.join(root, 'flat')
+        else:
+            dir_path = os.path.join(root, 'deep', *[f'l{d}' for d in range((i // 2) % (depth + 1))])
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, f'f{i}.txt'), 'w') as f:
+            f.write(f'file {i}\n' * (1 + i % 64))
+
+def make_huge(root: str, count: int, size: int):
+    os.makedirs(root, exist_ok=True)
+    block = os.urandom(1024 * 1024)
+    for i in range(count):
+        with open(os.path.join(root, f'dump{i}.bin'), 'wb') as f:
+            for j in range(size // len(block)):
+                # distinct blocks, so chunks don't trivially dedupe
+                f.write(j.to_bytes(8, 'big') + block[8:])
+
+def touch(root: str, count: int, huge_dir: str):
+    """
+    Change every `count`th small file and append to the first huge file
+    """
+    changed = 0
+    for path, _ in walk(os.path.join(root, 'small')):
+        changed += 1
+        if changed % count == 0:
+            with open(path, 'a') as f:
+                f.write('changed\n')
+    with open(os.path.join(huge_dir, 'dump0.bin'), 'ab') as f:
+        f.write(os.urandom(1024 * 1024))
+
+def make_conf(root: str, src: str, args) -> dict:
+    # values as YAML would load them, eg. `index=1` is a number rather than the string '1'
+    sync_conf = {key: json.loads(value) for key, value in (item.split('=', 1) for item in args.sync)}
+    has_rsync = shutil.which('rsync') is not None
+    if not has_rsync:
+        print('rsync not found, syncing the small files as an archive', file=sys.stderr)
+    paths = [
+        {"local": os.path.join(src, 'small'), "remote": 'small', "compress": None if has_rsync else 'tar', "branch": 'main'},
+        {"local": os.path.join(src, 'small', 'deep'), "remote": 'archives/deep.zip', "compress": 'zip', "branch": 'main'},
+        {"local": os.path.join(src, 'huge'), "remote": 'huge', "compress": None if has_rsync else 'tar', "branch": 'main'}
+    ]
+    repo = {
+        "storage_root": os.path.join(root, 'repos', 'bench', 'backup'),
+        "name": 'backup',
+        "owner": 'bench',
+        "branch": 'main',
+        "endpoint": f'file://{root}/remote',
+        "paths": paths,
+        "git": {"add": True, "commit": True, "push": True, "email": 'bench@example', "name": 'bench'},
+        "max_file_size": args.max_file_mb * 1024 * 1024,
+        "oversize_handler": 'chunking',
+        "chunking": {"mode": args.chunking}
+    }
+    return {
+        "version": 0,
+        "storage": {"repo_root": os.path.join(root, 'repos')},
+        "rsync": {"archive": True},
+        "sync": sync_conf,
+        "repos": [repo],
+        "secrets": Secrets({}),
+        "loop": {"loop": False, "interval": 1}
+    }
+
+def _io() -> dict:
+    # read/write syscalls of this process, children aren't included
+    with open('/proc/self/io', 'r') as f:
+        return {key: int(value) for key, value in (line.split(': ') for line in f)}
+
+def scenario(name: str, conf: dict, stats: Stats) -> dict:
+    stats.reset()
+    sync._fetched.clear()
+    io_before = _io() if os.path.exists('/proc/self/io') else None
+    start = time.perf_counter()
+    sync.sync(conf)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "scenario": name,
+        "seconds": round(elapsed, 3),
+        "stages": {k: {"calls": v['calls'], "seconds": round(v['seconds'], 3)} for k, v in sorted(stats.stages.items())},
+        "subprocesses": dict(sorted(stats.commands.items())),
+        "subprocess_total": sum(stats.commands.values()),
+        # kilobytes on linux, peak so far rather than per scenario
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_child_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    }
+    if io_before is not None:
+        io_after = _io()
+        result['syscalls'] = {key: io_after[key] - io_before[key] for key in ('syscr', 'syscw')}
+        result['io_bytes'] = {key: io_after[key] - io_before[key] for key in ('rchar', 'wchar')}
+    return result
+
+def run(args) -> dict:
+    stats = Stats()
+    instrument(stats)
+    root = tempfile.mkdtemp(prefix='git-backup-bench-')
+    try:
+        src = os.path.join(root, 'src')
+        make_small(os.path.join(src, 'small'), args.small_files, args.depth)
+        make_huge(os.path.join(src, 'huge'), args.huge_files, args.huge_mb * 1024 * 1024)
+        make_remote(root, 'main')
+        conf = make_conf(root, src, args)
+
+        results = [scenario('initial', conf, stats), scenario('unchanged', conf, stats)]
+        touch(src, 100, os.path.join(src, 'huge'))
+        results.append(scenario('changed', conf, stats))
+    finally:
+        shutil.rmtree(root)
+    return {
+        "params": {k: v for k, v in vars(args).items() if k not in ('out', 'compare')},
+        "results": results
+    }
+
+def compare(old: dict, new: dict):
+    old_results = {r['scenario']: r for r in old['results']}
+    for r in new['results']:
+        prev = old_results.get(r['scenario'])
+        if prev is None:
+            continue
+        change = (r['seconds'] - prev['seconds']) / prev['seconds'] * 100 if prev['seconds'] else 0
+        print(f'{r["scenario"]:>10}  {prev["seconds"]}s -> {r["seconds"]}s ({change:+.1f}%)  subprocesses {prev["subprocess_total"]} -> {r["subprocess_total"]}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sync() against a local bare repo')
+    parser.add_argument('--small-files', type=int, default=2000)
+    parser.add_argument('--depth', type=int, default=12, help='nesting of the deep small files')
+    parser.add_argument('--huge-files', type=int, default=2)
+    parser.add_argument('--huge-mb', type=int, default=64)
+    parser.add_argument('--max-file-mb', type=int, default=16)
+    parser.add_argument('--chunking', default='fixed', choices=('fixed', 'cdc'))
+    parser.add_argument('--sync', action='append', default=[], metavar='KEY=VALUE', help='`sync` config, eg. pipeline=2, index=1')
+    parser.add_argument('--out', default=None, help='write results as JSON to this path')
+    parser.add_argument('--compare', default=None, help='results JSON of a previous run to compare against')
+    args = parser.parse_args()
+
+    report = run(args)
+    for r in report['results']:
+        print(f'{r["scenario"]:>10}  {r["seconds"]:>8}s  subprocesses {r["subprocess_total"]:>4}  peak rss {r["peak_rss_kb"] // 1024}MB')
+        for name, stage in r['stages'].items():
+            print(f'{"":>12}{name:<18} {stage["calls"]:>5} calls {stage["seconds"]:>8}s')
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf8') as stream:
+            compare(json.load(stream), report)
+    if args.out:
+        with open(args.out, 'w', encoding='utf8') as stream:
+            json.dump(report, stream, indent=2)
+
+if __name__ == '__main__':
+    main()
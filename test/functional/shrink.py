@@ -0,0 +1,108 @@
+"""
+Sync a file that outgrows `max_file_size` and then shrinks back under it, against a
+local bare repo, and check the remote ends up with the file rather than stale chunks
+
+    python test/functional/shrink.py
+
+Covers a file inside a synced directory and a single synced file, needs no token.
+"""
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+os.environ.setdefault('LOG_LEVEL', '3')
+
+from git_backup.secrets import Secrets
+# `git_backup.sync` the module, not the function of the same name
+sync = importlib.import_module('git_backup.sync')
+
+MAX_FILE_SIZE = 1024
+
+def sh(*cmd, cwd=None) -> str:
+    return subprocess.run(cmd, cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+def make_remote(root: str, branch: str) -> str:
+    bare = os.path.join(root, 'remote', 'test', 'backup.git')
+    seed = os.path.join(root, 'seed')
+    sh('git', 'init', '-q', '--bare', '-b', branch, bare)
+    sh('git', 'init', '-q', '-b', branch, seed)
+    with open(os.path.join(seed, 'README'), 'w') as f:
+        f.write('test\n')
+    sh('git', 'add', '.', cwd=seed)
+    sh('git', '-c', 'user.email=test@example', '-c', 'user.name=test', 'commit', '-qm', 'init', cwd=seed)
+    sh('git', 'push', '-q', bare, f'{branch}:{branch}', cwd=seed)
+    shutil.rmtree(seed)
+    return bare
+
+def make_conf(root: str, src: str) -> dict:
+    paths = [
+        {"local": os.path.join(src, 'dir'), "remote": 'dir', "compress": None, "branch": 'main'},
+        {"local": os.path.join(src, 'single.bin'), "remote": 'single.bin', "compress": None, "branch": 'main'}
+    ]
+    repo = {
+        "storage_root": os.path.join(root, 'repos', 'test', 'backup'),
+        "name": 'backup',
+        "owner": 'test',
+        "branch": 'main',
+        "endpoint": f'file://{root}/remote',
+        "paths": paths,
+        "git": {"add": True, "commit": True, "push": True, "email": 'test@example', "name": 'test'},
+        "max_file_size": MAX_FILE_SIZE,
+        "oversize_handler": 'chunking',
+        "chunking": {"mode": 'fixed'}
+    }
+    return {
+        "version": 0,
+        "storage": {"repo_root": os.path.join(root, 'repos')},
+        # copies without rsync when it isn't installed
+        "rsync": {"archive": True, "reflink": shutil.which('rsync') is None},
+        "repos": [repo],
+        "secrets": Secrets({}),
+        "loop": {"loop": False, "interval": 1}
+    }
+
+def write(path: str, size: int, fill: bytes):
+    with open(path, 'wb') as f:
+        f.write(fill * size)
+
+def check(condition: bool, message: str):
+    if not condition:
+        print(f'Test failed, {message}')
+        sys.exit(1)
+
+def main():
+    root = tempfile.mkdtemp(prefix='git-backup-test-')
+    try:
+        src = os.path.join(root, 'src')
+        os.makedirs(os.path.join(src, 'dir'))
+        write(os.path.join(src, 'dir', 'small.txt'), 10, b's')
+        write(os.path.join(src, 'dir', 'big.bin'), MAX_FILE_SIZE * 3, b'a')
+        write(os.path.join(src, 'single.bin'), MAX_FILE_SIZE * 3, b'a')
+        bare = make_remote(root, 'main')
+        conf = make_conf(root, src)
+
+        sync.sync(conf)
+        files = sh('git', 'ls-tree', '-r', '--name-only', 'main', cwd=bare).split()
+        for name in ('dir/big.bin', 'single.bin'):
+            check(name not in files and f'{name}.d/manifest' in files, f'{name} was not chunked: {files}')
+
+        write(os.path.join(src, 'dir', 'big.bin'), MAX_FILE_SIZE // 2, b'b')
+        write(os.path.join(src, 'single.bin'), MAX_FILE_SIZE // 2, b'b')
+        sync._fetched.clear()
+        sync.sync(conf)
+        files = sh('git', 'ls-tree', '-r', '--name-only', 'main', cwd=bare).split()
+        for name in ('dir/big.bin', 'single.bin'):
+            check(name in files, f'shrunk {name} was not backed up: {files}')
+            check(not any(f.startswith(f'{name}.d/') for f in files), f'stale chunks of {name} left: {files}')
+            content = sh('git', 'show', f'main:{name}', cwd=bare)
+            check(content == 'b' * (MAX_FILE_SIZE // 2), f'{name} has stale content')
+        print('ok')
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()